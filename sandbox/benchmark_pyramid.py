@@ -0,0 +1,51 @@
+import time
+import tracemalloc
+import numpy as np
+from focusstack.algorithms.pyramid import PyramidStack
+
+
+class PerChannelPyramidStack(PyramidStack):
+    def reduce_layer(self, layer):
+        if len(layer.shape) == 2:
+            return self.convolve(layer)[::2, ::2]
+        reduced_channels = [self.reduce_layer(layer[:, :, channel]) for channel in range(layer.shape[2])]
+        return np.stack(reduced_channels, axis=-1)
+
+    def expand_layer(self, layer):
+        if len(layer.shape) == 2:
+            expand = np.empty((2 * layer.shape[0], 2 * layer.shape[1]), dtype=layer.dtype)
+            expand[::2, ::2] = layer
+            expand[1::2, :] = 0
+            expand[:, 1::2] = 0
+            return 4. * self.convolve(expand)
+        ch_layer = self.expand_layer(layer[:, :, 0])
+        next_layer = np.zeros(list(ch_layer.shape) + [layer.shape[2]], dtype=layer.dtype)
+        next_layer[:, :, 0] = ch_layer
+        for channel in range(1, layer.shape[2]):
+            next_layer[:, :, channel] = self.expand_layer(layer[:, :, channel])
+        return next_layer
+
+
+def benchmark(stack, frames, levels):
+    stack.process_single_image(frames[0], levels)
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    for frame in frames:
+        tracemalloc.reset_peak()
+        stack.process_single_image(frame, levels)
+        _, peak = tracemalloc.get_traced_memory()
+    dt = (time.perf_counter() - t0) / len(frames)
+    tracemalloc.stop()
+    return dt, peak
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(1234)
+    shape = (2000, 3000, 3)
+    frames = [rng.integers(0, 256, size=shape, dtype=np.uint8) for _ in range(5)]
+    levels = int(np.log2(min(shape[:2]) / 32))
+    print(f"frame size: {shape[1]}x{shape[0]}, levels: {levels}")
+    for name, stack in [('per channel', PerChannelPyramidStack(max_threads=1)),
+                        ('multi channel', PyramidStack(max_threads=1))]:
+        dt, peak = benchmark(stack, frames, levels)
+        print(f"{name:>14}: {dt * 1000:8.1f} ms/frame, peak allocation: {peak / 2 ** 20:8.1f} MB/frame")
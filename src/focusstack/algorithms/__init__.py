@@ -5,7 +5,7 @@ from .align import AlignFrames
 from .balance import BalanceFrames
 from .stack import FocusStackBunch, FocusStack
 from .depth_map import DepthMapStack
-from .pyramid import PyramidStack
+from .pyramid import PyramidStack, PyramidBlock
 from .multilayer import MultiLayer
 from .noise_detection import NoiseDetection, MaskNoise
 from .vignetting import Vignetting
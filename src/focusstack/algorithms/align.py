@@ -1,3 +1,8 @@
+import os
+import csv
+import json
+import math
+import time
 import matplotlib.pyplot as plt
 import cv2
 import numpy as np
@@ -5,12 +10,14 @@ import logging
 from .. config.constants import constants
 from .. core.exceptions import AlignmentError, InvalidOptionError
 from .utils import img_8bit, img_bw_8bit, save_plot
-from .utils import get_img_metadata, validate_image
+from .utils import get_img_metadata, validate_image, file_hash
 from .stack_framework import SubAction
 
 _DEFAULT_FEATURE_CONFIG = {
     'detector': constants.DEFAULT_DETECTOR,
-    'descriptor': constants.DEFAULT_DESCRIPTOR
+    'descriptor': constants.DEFAULT_DESCRIPTOR,
+    'max_keypoints': constants.DEFAULT_MAX_KEYPOINTS,
+    'keypoint_grid': constants.DEFAULT_KEYPOINT_GRID
 }
 
 _DEFAULT_MATCHING_CONFIG = {
@@ -32,9 +39,24 @@ _DEFAULT_ALIGNMENT_CONFIG = {
     'border_value': constants.DEFAULT_BORDER_VALUE,
     'border_blur': constants.DEFAULT_BORDER_BLUR,
     'subsample': constants.DEFAULT_ALIGN_SUBSAMPLE,
-    'fast_subsampling': constants.DEFAULT_ALIGN_FAST_SUBSAMPLING
+    'fast_subsampling': constants.DEFAULT_ALIGN_FAST_SUBSAMPLING,
+    'ecc_refinement': constants.DEFAULT_ALIGN_ECC_REFINEMENT,
+    'ecc_levels': constants.DEFAULT_ALIGN_ECC_LEVELS,
+    'ecc_min_level': constants.DEFAULT_ALIGN_ECC_MIN_LEVEL,
+    'ecc_roi': constants.DEFAULT_ALIGN_ECC_ROI,
+    'ecc_max_iters': constants.DEFAULT_ALIGN_ECC_MAX_ITERS,
+    'ecc_epsilon': constants.DEFAULT_ALIGN_ECC_EPSILON,
+    'phase_scale': constants.DEFAULT_ALIGN_PHASE_SCALE,
+    'min_confidence': constants.DEFAULT_ALIGN_MIN_CONFIDENCE
 }
 
+_WARP_ONLY_KEYS = ('border_mode', 'border_value', 'border_blur')
+
+_BORDER_BLUR_KERNEL = 21
+
+_PROFILE_STAGES = ('subsample', 'detection', 'matching', 'ransac', 'phase_correlation', 'ecc', 'plot', 'warp', 'blur')
+_PROFILE_COUNTS = ('keypoints', 'ref_keypoints', 'matches', 'inliers', 'inlier_ratio', 'bytes')
+
 
 _cv2_border_mode_map = {
     constants.BORDER_CONSTANT: cv2.BORDER_CONSTANT,
@@ -43,27 +65,35 @@ _cv2_border_mode_map = {
 }
 
 
-def get_good_matches(des_0, des_1, matching_config=None):
+def train_matcher(des_1, matching_config=None):
     matching_config = {**_DEFAULT_MATCHING_CONFIG, **(matching_config or {})}
     match_method = matching_config['match_method']
-    good_matches = []
     if match_method == constants.MATCHING_KNN:
-        flann = cv2.FlannBasedMatcher(
+        matcher = cv2.FlannBasedMatcher(
             dict(algorithm=matching_config['flann_idx_kdtree'], trees=matching_config['flann_trees']),
             dict(checks=matching_config['flann_checks']))
-        matches = flann.knnMatch(des_0, des_1, k=2)
-        good_matches = [m for m, n in matches if m.distance < matching_config['threshold'] * n.distance]
+        matcher.add([des_1])
+        matcher.train()
     elif match_method == constants.MATCHING_NORM_HAMMING:
-        bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
-        good_matches = sorted(bf.match(des_0, des_1), key=lambda x: x.distance)
+        matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
     else:
         raise InvalidOptionError('match_method', match_method, f". Valid options are: {constants.MATCHING_KNN}, {constants.MATCHING_NORM_HAMMING}")
-    return good_matches
+    return matcher
 
 
-def detect_and_compute(img_0, img_1, feature_config=None, matching_config=None):
-    feature_config = {**_DEFAULT_FEATURE_CONFIG, **(feature_config or {})}
+def get_good_matches(des_0, des_1, matching_config=None, matcher=None):
     matching_config = {**_DEFAULT_MATCHING_CONFIG, **(matching_config or {})}
+    if matcher is None:
+        matcher = train_matcher(des_1, matching_config)
+    if matching_config['match_method'] == constants.MATCHING_KNN:
+        matches = matcher.knnMatch(des_0, k=2)
+        good_matches = [m for m, n in matches if m.distance < matching_config['threshold'] * n.distance]
+    else:
+        good_matches = sorted(matcher.match(des_0, des_1), key=lambda x: x.distance)
+    return good_matches
+
+
+def check_feature_config(feature_config, matching_config):
     feature_config_detector = feature_config['detector']
     feature_config_descriptor = feature_config['descriptor']
     match_method = matching_config['match_method']
@@ -78,7 +108,35 @@ def detect_and_compute(img_0, img_1, feature_config=None, matching_config=None):
             feature_config_descriptor in constants.NOKNN_METHODS['descriptors'] and \
             match_method != constants.MATCHING_NORM_HAMMING:
         raise ValueError(f"Detector {feature_config_detector} and descriptor {feature_config_descriptor} require matching method Hamming distance")
-    img_bw_0, img_bw_1 = img_bw_8bit(img_0), img_bw_8bit(img_1)
+
+
+def select_keypoints(keypoints, shape, max_keypoints, grid=constants.DEFAULT_KEYPOINT_GRID):
+    if max_keypoints <= 0 or len(keypoints) <= max_keypoints:
+        return keypoints
+    h, w = shape[:2]
+    # shrink the grid for small budgets, so that each cell keeps at least one keypoint
+    grid = max(1, min(grid, math.isqrt(max_keypoints)))
+    points = np.array([kp.pt for kp in keypoints])
+    response = np.array([kp.response for kp in keypoints])
+    cell_x = np.minimum((points[:, 0] * grid / w).astype(int), grid - 1)
+    cell_y = np.minimum((points[:, 1] * grid / h).astype(int), grid - 1)
+    cell = cell_y * grid + cell_x
+    # rank of each keypoint by decreasing response within its grid cell
+    order = np.lexsort((-response, cell))
+    cell_sorted = cell[order]
+    rank = np.arange(len(order)) - np.searchsorted(cell_sorted, cell_sorted)
+    selected = order[rank < max_keypoints // (grid * grid)]
+    # cells with few keypoints leave part of the budget, filled with the strongest remaining ones
+    remaining = np.setdiff1d(np.arange(len(keypoints)), selected)
+    remaining = remaining[np.argsort(-response[remaining], kind='stable')][:max_keypoints - len(selected)]
+    return tuple(keypoints[i] for i in np.sort(np.concatenate((selected, remaining))))
+
+
+def detect_features(img, feature_config=None):
+    feature_config = {**_DEFAULT_FEATURE_CONFIG, **(feature_config or {})}
+    feature_config_detector = feature_config['detector']
+    feature_config_descriptor = feature_config['descriptor']
+    img_bw = img_bw_8bit(img)
     detector_map = {
         constants.DETECTOR_SIFT: cv2.SIFT_create,
         constants.DETECTOR_ORB: cv2.ORB_create,
@@ -93,15 +151,46 @@ def detect_and_compute(img_0, img_1, feature_config=None, matching_config=None):
         constants.DETECTOR_BRISK: cv2.BRISK_create
     }
     detector = detector_map[feature_config_detector]()
-    if feature_config_detector == feature_config_descriptor and \
-       feature_config_detector in (constants.DETECTOR_SIFT, constants.DETECTOR_AKAZE, constants.DETECTOR_BRISK):
-        kp_0, des_0 = detector.detectAndCompute(img_bw_0, None)
-        kp_1, des_1 = detector.detectAndCompute(img_bw_1, None)
-    else:
-        descriptor = descriptor_map[feature_config_descriptor]()
-        kp_0, des_0 = descriptor.compute(img_bw_0, detector.detect(img_bw_0, None))
-        kp_1, des_1 = descriptor.compute(img_bw_1, detector.detect(img_bw_1, None))
-    return kp_0, kp_1, get_good_matches(des_0, des_1, matching_config)
+    same_method = feature_config_detector == feature_config_descriptor and \
+        feature_config_detector in (constants.DETECTOR_SIFT, constants.DETECTOR_AKAZE, constants.DETECTOR_BRISK)
+    if same_method and feature_config['max_keypoints'] <= 0:
+        return detector.detectAndCompute(img_bw, None)
+    descriptor = detector if same_method else descriptor_map[feature_config_descriptor]()
+    keypoints = select_keypoints(detector.detect(img_bw, None), img_bw.shape,
+                                 feature_config['max_keypoints'], feature_config['keypoint_grid'])
+    return descriptor.compute(img_bw, keypoints)
+
+
+def reference_features(img_1, feature_config=None, matching_config=None):
+    feature_config = {**_DEFAULT_FEATURE_CONFIG, **(feature_config or {})}
+    matching_config = {**_DEFAULT_MATCHING_CONFIG, **(matching_config or {})}
+    check_feature_config(feature_config, matching_config)
+    kp_1, des_1 = detect_features(img_1, feature_config)
+    return kp_1, des_1, train_matcher(des_1, matching_config)
+
+
+def transform_features(kp, des, M, shape, matching_config=None):
+    if len(kp) == 0:
+        return None
+    pts = np.float32([k.pt for k in kp]).reshape(-1, 1, 2)
+    pts = cv2.perspectiveTransform(pts, M) if M.shape == (3, 3) else cv2.transform(pts, M)
+    pts = pts.reshape(-1, 2)
+    h, w = shape[:2]
+    inside = np.flatnonzero((pts[:, 0] >= 0) & (pts[:, 0] < w) & (pts[:, 1] >= 0) & (pts[:, 1] < h))
+    if len(inside) == 0:
+        return None
+    kp_t = [cv2.KeyPoint(float(pts[i, 0]), float(pts[i, 1]), kp[i].size, kp[i].angle, kp[i].response,
+                         kp[i].octave, kp[i].class_id) for i in inside]
+    des_t = des[inside]
+    return kp_t, des_t, train_matcher(des_t, matching_config)
+
+
+def detect_and_compute(img_0, img_1, feature_config=None, matching_config=None):
+    feature_config = {**_DEFAULT_FEATURE_CONFIG, **(feature_config or {})}
+    matching_config = {**_DEFAULT_MATCHING_CONFIG, **(matching_config or {})}
+    kp_1, des_1, matcher = reference_features(img_1, feature_config, matching_config)
+    kp_0, des_0 = detect_features(img_0, feature_config)
+    return kp_0, kp_1, get_good_matches(des_0, des_1, matching_config, matcher)
 
 
 def find_transform(src_pts, dst_pts, transform=constants.DEFAULT_TRANSFORM,
@@ -125,35 +214,259 @@ def find_transform(src_pts, dst_pts, transform=constants.DEFAULT_TRANSFORM,
                                              ransacReprojThreshold=rans_threshold,
                                              confidence=align_confidence / 100.0,
                                              refineIters=refine_iters)
+    elif transform == constants.ALIGN_TRANSLATION:
+        raise InvalidOptionError("transform", transform, ": translation is estimated by phase correlation, not from matches")
     else:
         raise InvalidOptionError("transform", transform)
     return result
 
 
-def align_images(img_1, img_0, feature_config=None, matching_config=None, alignment_config=None,
-                 plot_path=None, callbacks=None):
-    feature_config = {**_DEFAULT_FEATURE_CONFIG, **(feature_config or {})}
-    matching_config = {**_DEFAULT_MATCHING_CONFIG, **(matching_config or {})}
+def gray_float(img):
+    gray = img if len(img.shape) == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return gray.astype(np.float32)
+
+
+def ecc_roi_mask(shape, roi):
+    h, w = shape[:2]
+    if roi >= 1:
+        return None
+    mask = np.zeros((h, w), dtype=np.uint8)
+    dh, dw = int(h * (1 - roi) / 2), int(w * (1 - roi) / 2)
+    mask[dh:h - dh, dw:w - dw] = 255
+    return mask
+
+
+def log_polar_spectrum(gray, radius, size):
+    h, w = gray.shape
+    spectrum = np.abs(np.fft.fftshift(np.fft.fft2(gray * cv2.createHanningWindow((w, h), cv2.CV_32F))))
+    # high-pass emphasis, the low frequencies would otherwise dominate the correlation
+    cos_y = np.cos(np.pi * (np.arange(h) / h - 0.5))[:, np.newaxis]
+    cos_x = np.cos(np.pi * (np.arange(w) / w - 0.5))[np.newaxis, :]
+    spectrum *= (1 - cos_y * cos_x) * (2 - cos_y * cos_x)
+    return cv2.warpPolar(spectrum.astype(np.float32), size, (w / 2, h / 2), radius,
+                         cv2.WARP_POLAR_LOG + cv2.INTER_LINEAR)
+
+
+def phase_correlation_scale(gray_1, gray_0):
+    radius = min(gray_1.shape) / 2
+    size = (4 * int(radius), 360)
+    (shift, _), _ = cv2.phaseCorrelate(log_polar_spectrum(gray_1, radius, size),
+                                       log_polar_spectrum(gray_0, radius, size))
+    return np.exp(shift * np.log(radius) / size[0])
+
+
+def phase_correlation_transform(img_1, img_0, alignment_config=None):
+    alignment_config = {**_DEFAULT_ALIGNMENT_CONFIG, **(alignment_config or {})}
+    gray_1 = gray_float(subsample_image(img_1, alignment_config))
+    gray_0 = gray_float(subsample_image(img_0, alignment_config))
+    h, w = gray_0.shape
+    scale = phase_correlation_scale(gray_1, gray_0) if alignment_config['phase_scale'] else 1.0
+    M = cv2.getRotationMatrix2D((w / 2, h / 2), 0, scale)
+    if scale != 1.0:
+        gray_0 = cv2.warpAffine(gray_0, M, (w, h), borderMode=cv2.BORDER_REPLICATE)
+    (dx, dy), confidence = cv2.phaseCorrelate(gray_1, gray_0, cv2.createHanningWindow((w, h), cv2.CV_32F))
+    M[:, 2] -= (dx, dy)
+    M[:, 2] *= max(alignment_config['subsample'], 1)
+    return confidence, M
+
+
+def refine_transform_ecc(img_1, img_0, M, alignment_config=None):
+    alignment_config = {**_DEFAULT_ALIGNMENT_CONFIG, **(alignment_config or {})}
+    levels = alignment_config['ecc_levels']
+    if levels < 1:
+        raise InvalidOptionError("ecc_levels", levels, ": must be at least 1")
+    min_level = alignment_config['ecc_min_level']
+    if min_level < 0:
+        raise InvalidOptionError("ecc_min_level", min_level, ": must be at least 0")
+    if not 0 < alignment_config['ecc_roi'] <= 1:
+        raise InvalidOptionError("ecc_roi", alignment_config['ecc_roi'], ": must be in the range (0, 1]")
+    homography = M.shape == (3, 3)
+    motion = cv2.MOTION_HOMOGRAPHY if homography else cv2.MOTION_AFFINE
+    criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT,
+                alignment_config['ecc_max_iters'], alignment_config['ecc_epsilon'])
+    # level n has 1/2^n of the full resolution, the finest level min_level skips the most expensive passes
+    pyramid_1, pyramid_0 = [gray_float(img_1)], [gray_float(img_0)]
+    for _ in range(min_level + levels - 1):
+        pyramid_1.append(cv2.pyrDown(pyramid_1[-1]))
+        pyramid_0.append(cv2.pyrDown(pyramid_0[-1]))
+    M_3 = np.eye(3)
+    M_3[:M.shape[0]] = M
+    if abs(np.linalg.det(M_3)) < 1e-12:
+        # a degenerate estimate cannot be inverted and refined
+        return M
+    # ECC estimates the warp from reference to frame coordinates, i.e. the inverse of M
+    W = np.linalg.inv(M_3)
+    for level in range(min_level + levels - 1, min_level - 1, -1):
+        scale = np.diag([0.5 ** level, 0.5 ** level, 1.0])
+        W_level = (scale @ W @ np.linalg.inv(scale)).astype(np.float32)
+        template = pyramid_1[level]
+        mask = ecc_roi_mask(template.shape, alignment_config['ecc_roi'])
+        try:
+            _, W_level = cv2.findTransformECC(template, pyramid_0[level], W_level if homography else W_level[:2],
+                                              motion, criteria, mask, 5)
+        except cv2.error:
+            # keep the last converged estimate and let finer levels refine it
+            continue
+        W = np.eye(3)
+        W[:W_level.shape[0]] = W_level
+        W = np.linalg.inv(scale) @ W @ scale
+    M_3 = np.linalg.inv(W)
+    if homography:
+        return M_3 / M_3[2, 2]
+    # project back to a similarity transform, consistent with ALIGN_RIGID
+    a, b = (M_3[0, 0] + M_3[1, 1]) / 2, (M_3[1, 0] - M_3[0, 1]) / 2
+    return np.array([[a, -b, M_3[0, 2]], [b, a, M_3[1, 2]]])
+
+
+def subsample_image(img, alignment_config=None):
+    alignment_config = {**_DEFAULT_ALIGNMENT_CONFIG, **(alignment_config or {})}
+    subsample = alignment_config['subsample']
+    if subsample <= 1:
+        return img
+    if alignment_config['fast_subsampling']:
+        return img[::subsample, ::subsample]
+    return cv2.resize(img, (0, 0), fx=1 / subsample, fy=1 / subsample, interpolation=cv2.INTER_AREA)
+
+
+def border_strips(M, shape):
+    h, w = shape[:2]
+    M_3 = np.eye(3)
+    M_3[:M.shape[0]] = M
+    corners = np.array([[[-0.5, -0.5], [w - 0.5, -0.5], [w - 0.5, h - 0.5], [-0.5, h - 0.5]]])
+    corners = cv2.perspectiveTransform(corners, M_3)[0]
+    # axis-aligned rectangle inside the warped frame: pixels out of it may map outside the source image
+    x_0 = int(np.clip(np.ceil(max(corners[0, 0], corners[3, 0])) + 1, 0, w))
+    x_1 = int(np.clip(np.floor(min(corners[1, 0], corners[2, 0])), 0, w))
+    y_0 = int(np.clip(np.ceil(max(corners[0, 1], corners[1, 1])) + 1, 0, h))
+    y_1 = int(np.clip(np.floor(min(corners[2, 1], corners[3, 1])), 0, h))
+    if x_0 >= x_1 or y_0 >= y_1:
+        return [(0, h, 0, w)]
+    strips = [(0, y_0, 0, w), (y_1, h, 0, w), (y_0, y_1, 0, x_0), (y_0, y_1, x_1, w)]
+    return [s for s in strips if s[0] < s[1] and s[2] < s[3]]
+
+
+def invalid_pixels(M_inv, shape, strip):
+    h, w = shape[:2]
+    r_0, r_1, c_0, c_1 = strip
+    ys, xs = np.mgrid[r_0:r_1, c_0:c_1].astype(np.float64)
+    x_src = M_inv[0, 0] * xs + M_inv[0, 1] * ys + M_inv[0, 2]
+    y_src = M_inv[1, 0] * xs + M_inv[1, 1] * ys + M_inv[1, 2]
+    if M_inv.shape == (3, 3):
+        z_src = M_inv[2, 0] * xs + M_inv[2, 1] * ys + M_inv[2, 2]
+        x_src, y_src = x_src / z_src, y_src / z_src
+    # bilinear weight of the source pixels inside the image, as in a warped mask of ones,
+    # with coordinates rounded to the 1/32 pixel precision of OpenCV remapping
+    x_src, y_src = np.round(x_src * 32) / 32, np.round(y_src * 32) / 32
+    w_x = np.clip(np.minimum(x_src + 1, w - x_src), 0, 1)
+    w_y = np.clip(np.minimum(y_src + 1, h - y_src), 0, 1)
+    return w_x * w_y < 0.5
+
+
+def blur_border(img_warp, M, border_blur):
+    h, w = img_warp.shape[:2]
+    M_inv = cv2.invertAffineTransform(M) if M.shape == (2, 3) else np.linalg.inv(M)
+    pad = _BORDER_BLUR_KERNEL // 2
+    blurred_strips = []
+    for strip in border_strips(M, img_warp.shape):
+        invalid = invalid_pixels(M_inv, img_warp.shape, strip)
+        if not invalid.any():
+            continue
+        r_0, r_1, c_0, c_1 = strip
+        p_r, p_c = max(r_0 - pad, 0), max(c_0 - pad, 0)
+        blurred = cv2.GaussianBlur(img_warp[p_r:min(r_1 + pad, h), p_c:min(c_1 + pad, w)],
+                                   (_BORDER_BLUR_KERNEL, _BORDER_BLUR_KERNEL), sigmaX=border_blur)
+        blurred_strips.append((strip, invalid, blurred[r_0 - p_r:r_1 - p_r, c_0 - p_c:c_1 - p_c][invalid]))
+    for (r_0, r_1, c_0, c_1), invalid, values in blurred_strips:
+        img_warp[r_0:r_1, c_0:c_1][invalid] = values
+
+
+def profile_stage(profile, stage, start):
+    now = time.perf_counter()
+    if profile is not None:
+        profile[stage] = profile.get(stage, 0.0) + now - start
+    return now
+
+
+def warp_image(img_0, M, alignment_config=None, callbacks=None, profile=None):
     alignment_config = {**_DEFAULT_ALIGNMENT_CONFIG, **(alignment_config or {})}
     try:
         cv2_border_mode = _cv2_border_mode_map[alignment_config['border_mode']]
     except KeyError:
         raise InvalidOptionError("border_mode", alignment_config['border_mode'])
+    h, w = img_0.shape[:2]
+    if callbacks and 'align_message' in callbacks.keys():
+        callbacks['align_message']()
+    start = time.perf_counter()
+    if M.shape == (3, 3):
+        img_warp = cv2.warpPerspective(img_0, M, (w, h),
+                                       borderMode=cv2_border_mode, borderValue=alignment_config['border_value'])
+    else:
+        img_warp = cv2.warpAffine(img_0, M, (w, h),
+                                  borderMode=cv2_border_mode, borderValue=alignment_config['border_value'])
+    start = profile_stage(profile, 'warp', start)
+    if alignment_config['border_mode'] == constants.BORDER_REPLICATE_BLUR:
+        if callbacks and 'blur_message' in callbacks.keys():
+            callbacks['blur_message']()
+        blur_border(img_warp, M, alignment_config['border_blur'])
+        profile_stage(profile, 'blur', start)
+    return img_warp
+
+
+def align_images_phase_correlation(img_1, img_0, alignment_config, callbacks=None):
+    if img_1 is None:
+        raise InvalidOptionError("transform", constants.ALIGN_TRANSLATION, ": the reference image is required")
+    profile = {'bytes': img_0.nbytes + img_1.nbytes}
+    if callbacks and 'message' in callbacks.keys():
+        callbacks['message']()
+    start = time.perf_counter()
+    confidence, M = phase_correlation_transform(img_1, img_0, alignment_config)
+    start = profile_stage(profile, 'phase_correlation', start)
+    if callbacks and 'matches_message' in callbacks.keys():
+        callbacks['matches_message'](confidence)
+    img_warp = None
+    if confidence >= alignment_config['min_confidence']:
+        if alignment_config['ecc_refinement']:
+            if callbacks and 'ecc_message' in callbacks.keys():
+                callbacks['ecc_message']()
+            M = refine_transform_ecc(img_1, img_0, M, alignment_config)
+            profile_stage(profile, 'ecc', start)
+        img_warp = warp_image(img_0, M, alignment_config, callbacks, profile)
+    else:
+        M = None
+    if callbacks and 'profile' in callbacks.keys():
+        callbacks['profile'](profile)
+    return confidence, M, img_warp
+
+
+def align_images(img_1, img_0, feature_config=None, matching_config=None, alignment_config=None,
+                 plot_path=None, callbacks=None, ref_features=None):
+    feature_config = {**_DEFAULT_FEATURE_CONFIG, **(feature_config or {})}
+    matching_config = {**_DEFAULT_MATCHING_CONFIG, **(matching_config or {})}
+    alignment_config = {**_DEFAULT_ALIGNMENT_CONFIG, **(alignment_config or {})}
+    if alignment_config['border_mode'] not in _cv2_border_mode_map:
+        raise InvalidOptionError("border_mode", alignment_config['border_mode'])
     min_matches = 4 if alignment_config['transform'] == constants.ALIGN_HOMOGRAPHY else 3
-    validate_image(img_0, *get_img_metadata(img_1))
+    if img_1 is not None:
+        validate_image(img_0, *get_img_metadata(img_1))
+    if alignment_config['transform'] == constants.ALIGN_TRANSLATION:
+        return align_images_phase_correlation(img_1, img_0, alignment_config, callbacks)
     if callbacks and 'message' in callbacks.keys():
         callbacks['message']()
+    profile = {'bytes': img_0.nbytes + (0 if img_1 is None else img_1.nbytes)}
+    start = time.perf_counter()
     subsample = alignment_config['subsample']
-    if subsample > 1:
-        if alignment_config['fast_subsampling']:
-            img_0_sub, img_1_sub = img_0[::subsample, ::subsample], img_1[::subsample, ::subsample]
-        else:
-            img_0_sub = cv2.resize(img_0, (0, 0), fx=1 / subsample, fy=1 / subsample, interpolation=cv2.INTER_AREA)
-            img_1_sub = cv2.resize(img_1, (0, 0), fx=1 / subsample, fy=1 / subsample, interpolation=cv2.INTER_AREA)
-    else:
-        img_0_sub, img_1_sub = img_0, img_1
-    kp_0, kp_1, good_matches = detect_and_compute(img_0_sub, img_1_sub, feature_config, matching_config)
+    img_0_sub = subsample_image(img_0, alignment_config)
+    img_1_sub = None if img_1 is None else subsample_image(img_1, alignment_config)
+    start = profile_stage(profile, 'subsample', start)
+    if ref_features is None:
+        ref_features = reference_features(img_1_sub, feature_config, matching_config)
+    kp_1, des_1, matcher = ref_features
+    kp_0, des_0 = detect_features(img_0_sub, feature_config)
+    start = profile_stage(profile, 'detection', start)
+    good_matches = get_good_matches(des_0, des_1, matching_config, matcher)
+    start = profile_stage(profile, 'matching', start)
     n_good_matches = len(good_matches)
+    profile.update(keypoints=len(kp_0), ref_keypoints=len(kp_1), matches=n_good_matches)
     if callbacks and 'matches_message' in callbacks.keys():
         callbacks['matches_message'](n_good_matches)
     img_warp = None
@@ -165,7 +478,10 @@ def align_images(img_1, img_0, feature_config=None, matching_config=None, alignm
         M, msk = find_transform(src_pts, dst_pts, transform, alignment_config['align_method'],
                                 alignment_config['rans_threshold'], alignment_config['max_iters'],
                                 alignment_config['align_confidence'], alignment_config['refine_iters'])
-        if plot_path is not None:
+        start = profile_stage(profile, 'ransac', start)
+        if msk is not None:
+            profile.update(inliers=int(np.count_nonzero(msk)), inlier_ratio=np.count_nonzero(msk) / n_good_matches)
+        if plot_path is not None and img_1_sub is not None:
             matches_mask = msk.ravel().tolist()
             img_match = cv2.cvtColor(cv2.drawMatches(img_8bit(img_0_sub), kp_0, img_8bit(img_1_sub),
                                                      kp_1, good_matches, None, matchColor=(0, 255, 0),
@@ -176,6 +492,7 @@ def align_images(img_1, img_0, feature_config=None, matching_config=None, alignm
             plt.savefig(plot_path)
             if callbacks and 'save_plot' in callbacks.keys():
                 callbacks['save_plot'](plot_path)
+            start = profile_stage(profile, 'plot', start)
         h, w = img_0.shape[:2]
         h_sub, w_sub = img_0_sub.shape[:2]
         if subsample > 1:
@@ -194,27 +511,27 @@ def align_images(img_1, img_0, feature_config=None, matching_config=None, alignm
                 M[:, 2] = translation_fullres
             else:
                 raise InvalidOptionError("transform", transform)
-        if callbacks and 'align_message' in callbacks.keys():
-            callbacks['align_message']()
-        img_mask = np.ones_like(img_0, dtype=np.uint8)
-        if alignment_config['transform'] == constants.ALIGN_HOMOGRAPHY:
-            img_warp = cv2.warpPerspective(img_0, M, (w, h),
-                                           borderMode=cv2_border_mode, borderValue=alignment_config['border_value'])
-            if alignment_config['border_mode'] == constants.BORDER_REPLICATE_BLUR:
-                mask = cv2.warpPerspective(img_mask, M, (w, h),
-                                           borderMode=cv2.BORDER_CONSTANT, borderValue=0)
-        elif alignment_config['transform'] == constants.ALIGN_RIGID:
-            img_warp = cv2.warpAffine(img_0, M, (w, h),
-                                      borderMode=cv2_border_mode, borderValue=alignment_config['border_value'])
-            if alignment_config['border_mode'] == constants.BORDER_REPLICATE_BLUR:
-                mask = cv2.warpAffine(img_mask, M, (w, h),
-                                      borderMode=cv2.BORDER_CONSTANT, borderValue=0)
-        if alignment_config['border_mode'] == constants.BORDER_REPLICATE_BLUR:
-            if callbacks and 'blur_message' in callbacks.keys():
-                callbacks['blur_message']()
-            mask = cv2.cvtColor(mask, cv2.COLOR_BGR2GRAY)
-            blurred_warp = cv2.GaussianBlur(img_warp, (21, 21), sigmaX=alignment_config['border_blur'])
-            img_warp[mask == 0] = blurred_warp[mask == 0]
+        if alignment_config['ecc_refinement']:
+            if img_1 is None:
+                raise InvalidOptionError("ecc_refinement", True, ": the reference image is required")
+            if callbacks and 'ecc_message' in callbacks.keys():
+                callbacks['ecc_message']()
+            start = time.perf_counter()
+            M = refine_transform_ecc(img_1, img_0, M, alignment_config)
+            profile_stage(profile, 'ecc', start)
+        if callbacks and 'features' in callbacks.keys() and M is not None:
+            # carried keypoints are in subsampled coordinates, use the final transform scaled down
+            if subsample <= 1:
+                M_sub = M
+            elif transform == constants.ALIGN_HOMOGRAPHY:
+                M_sub = scale_down @ M @ scale_up
+            else:
+                M_sub = np.array(M, dtype=np.float32)
+                M_sub[:, 2] /= subsample
+            callbacks['features'](kp_0, des_0, M_sub, img_0_sub.shape)
+        img_warp = warp_image(img_0, M, alignment_config, callbacks, profile)
+    if callbacks and 'profile' in callbacks.keys():
+        callbacks['profile'](profile)
     return n_good_matches, M, img_warp
 
 
@@ -224,9 +541,10 @@ class AlignFrames(SubAction):
         self.feature_config = {**_DEFAULT_FEATURE_CONFIG, **(feature_config or {})}
         self.matching_config = {**_DEFAULT_MATCHING_CONFIG, **(matching_config or {})}
         self.alignment_config = {**_DEFAULT_ALIGNMENT_CONFIG, **(alignment_config or {})}
-        self.min_matches = 4 if self.alignment_config['transform'] == constants.ALIGN_HOMOGRAPHY else 3
         self.plot_summary = kwargs.get('plot_summary', False)
         self.plot_matches = kwargs.get('plot_matches', False)
+        self.plot_profile = kwargs.get('plot_profile', False)
+        self.apply_cached_transforms = kwargs.get('apply_cached_transforms', constants.DEFAULT_ALIGN_APPLY_CACHED)
         for k in self.feature_config.keys():
             if k in kwargs.keys():
                 self.feature_config[k] = kwargs[k]
@@ -236,24 +554,113 @@ class AlignFrames(SubAction):
         for k in self.alignment_config.keys():
             if k in kwargs.keys():
                 self.alignment_config[k] = kwargs[k]
+        self.phase_correlation = self.alignment_config['transform'] == constants.ALIGN_TRANSLATION
+        if self.phase_correlation:
+            self.min_matches = self.alignment_config['min_confidence']
+        else:
+            self.min_matches = 4 if self.alignment_config['transform'] == constants.ALIGN_HOMOGRAPHY else 3
+
+    def feature_key(self, ref_idx):
+        return (ref_idx, self.alignment_config['subsample'], self.alignment_config['fast_subsampling'],
+                self.feature_config['detector'], self.feature_config['descriptor'], self.matching_config['match_method'],
+                self.feature_config['max_keypoints'], self.feature_config['keypoint_grid'])
+
+    def transforms_config(self):
+        config = {**self.feature_config, **self.matching_config,
+                  **{k: v for k, v in self.alignment_config.items() if k not in _WARP_ONLY_KEYS}}
+        return json.loads(json.dumps(config))
+
+    def preserved_files(self):
+        return [constants.ALIGN_TRANSFORMS_FILE] if self.apply_cached_transforms else []
+
+    def transforms_path(self):
+        return os.path.join(self.process.output_dir, constants.ALIGN_TRANSFORMS_FILE)
+
+    def input_hash(self, idx):
+        if idx not in self.hashes:
+            self.hashes[idx] = file_hash(self.process.input_full_path + "/" + self.process.filenames[idx])
+        return self.hashes[idx]
+
+    def load_transforms(self):
+        path = self.transforms_path()
+        if not os.path.isfile(path):
+            self.process.sub_message(": no cached transforms found, computing alignment", level=logging.WARNING)
+            return {}
+        with open(path, 'r') as f:
+            data = json.load(f)
+        if data.get('config') != self.transforms_config():
+            self.process.sub_message(": alignment configuration changed, cached transforms ignored",
+                                     level=logging.WARNING)
+            return {}
+        return data.get('frames', {})
+
+    def cached_transform(self, idx, ref_idx):
+        entry = self.cached_transforms.get(self.process.filenames[idx], None)
+        if entry is None or ref_idx not in self.cache_valid or \
+                entry['ref'] != self.process.filenames[ref_idx] or \
+                entry['ref_hash'] != self.input_hash(ref_idx) or entry['hash'] != self.input_hash(idx):
+            return None
+        return entry
+
+    def record_transform(self, idx, ref_idx, n_matches, M):
+        self.transforms[self.process.filenames[idx]] = {
+            'hash': self.input_hash(idx),
+            'ref': self.process.filenames[ref_idx],
+            'ref_hash': self.input_hash(ref_idx),
+            'n_matches': n_matches,
+            'transform': M.tolist()
+        }
 
     def run_frame(self, idx, ref_idx, img_0):
         if idx == self.process.ref_idx:
             return img_0
-        img_ref = self.process.img_ref(ref_idx)
-        return self.align_images(idx, img_ref, img_0)
+        if self.apply_cached_transforms:
+            entry = self.cached_transform(idx, ref_idx)
+            if entry is not None:
+                self.process.sub_message_r(f": cached transform, matches: {entry['n_matches']}")
+                self.n_matches[idx] = entry['n_matches']
+                self.transforms[self.process.filenames[idx]] = entry
+                self.cache_valid.add(idx)
+                self.profiles[idx] = {'bytes': img_0.nbytes}
+                return warp_image(img_0, np.array(entry['transform']), self.alignment_config,
+                                  {'blur_message': lambda: self.process.sub_message_r(': blur borders')},
+                                  self.profiles[idx])
+        if self.phase_correlation:
+            return self.align_images(idx, ref_idx, self.process.img_ref(ref_idx), img_0)
+        ref_features = self.ref_features.get(self.feature_key(ref_idx), None)
+        if ref_features is None or self.plot_matches or self.alignment_config['ecc_refinement']:
+            img_ref = self.process.img_ref(ref_idx)
+        else:
+            img_ref = None
+        if ref_features is None:
+            ref_features = reference_features(subsample_image(img_ref, self.alignment_config),
+                                              self.feature_config, self.matching_config)
+            self.ref_features[self.feature_key(ref_idx)] = ref_features
+        return self.align_images(idx, ref_idx, img_ref, img_0, ref_features)
+
+    def carry_features(self, idx, kp, des, M, shape):
+        keep = self.feature_key(self.process.ref_idx)
+        self.ref_features = {k: v for k, v in self.ref_features.items() if k == keep}
+        features = transform_features(kp, des, M, shape, self.matching_config)
+        # without carried keypoints the next frame detects features on its reference
+        if features is not None:
+            self.ref_features[self.feature_key(idx)] = features
 
-    def align_images(self, idx, img_1, img_0):
+    def align_images(self, idx, ref_idx, img_1, img_0, ref_features=None):
         idx_str = "{:04d}".format(idx)
         callbacks = {
             'message': lambda: self.process.sub_message_r(': find matches'),
-            'matches_message': lambda n: self.process.sub_message_r(f": matches: {n}"),
+            'matches_message': lambda n: self.process.sub_message_r(
+                f": confidence: {n:.3f}" if self.phase_correlation else f": matches: {n}"),
             'align_message': lambda: self.process.sub_message_r(': align images'),
             'ecc_message': lambda: self.process.sub_message_r(": ecc refinement"),
             'blur_message': lambda: self.process.sub_message_r(': blur borders'),
+            'profile': lambda profile: self.profiles.__setitem__(idx, profile),
             'save_plot': lambda plot_path: self.process.callback('save_plot', self.process.id,
                                                                  f"{self.process.name}: matches\nframe {idx_str}", plot_path)
         }
+        if self.process.step_process:
+            callbacks['features'] = lambda kp, des, M, shape: self.carry_features(idx, kp, des, M, shape)
         if self.plot_matches:
             plot_path = f"{self.process.working_path}/{self.process.plot_path}/{self.process.name}-matches-{idx_str}.pdf"
         else:
@@ -264,19 +671,73 @@ class AlignFrames(SubAction):
             matching_config=self.matching_config,
             alignment_config=self.alignment_config,
             plot_path=plot_path,
-            callbacks=callbacks
+            callbacks=callbacks,
+            ref_features=ref_features
         )
         self.n_matches[idx] = n_good_matches
+        if self.phase_correlation and n_good_matches < self.min_matches:
+            self.process.sub_message(f": image not aligned, confidence too low: {n_good_matches:.3f}", level=logging.CRITICAL)
+            raise AlignmentError(idx, f"confidence too low: {n_good_matches:.3f} < {self.min_matches}")
         if n_good_matches < self.min_matches:
             self.process.sub_message(f": image not aligned, too few matches found: {n_good_matches}", level=logging.CRITICAL)
             raise AlignmentError(idx, f"too few matches found: {n_good_matches} < {self.min_matches}")
+        if self.apply_cached_transforms:
+            self.record_transform(idx, ref_idx, n_good_matches, M)
         return img
 
+    def frame_results(self, idx):
+        return self.n_matches[idx], self.transforms.get(self.process.filenames[idx], None), self.profiles.get(idx, None)
+
+    def set_frame_results(self, idx, results):
+        self.n_matches[idx], entry, profile = results
+        if entry is not None:
+            self.transforms[self.process.filenames[idx]] = entry
+        if profile is not None:
+            self.profiles[idx] = profile
+
     def begin(self, process):
         self.process = process
         self.n_matches = np.zeros(process.counts)
+        self.ref_features = {}
+        self.hashes = {}
+        self.transforms = {}
+        self.cache_valid = {process.ref_idx}
+        self.profiles = {}
+        self.cached_transforms = self.load_transforms() if self.apply_cached_transforms else {}
+
+    def save_profile(self):
+        path = f"{self.process.working_path}/{self.process.plot_path}/{self.process.name}-profile"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        frames = sorted(self.profiles.keys())
+        with open(f"{path}.csv", 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('frame', 'filename') + _PROFILE_STAGES + _PROFILE_COUNTS)
+            for idx in frames:
+                profile = self.profiles[idx]
+                writer.writerow([idx, self.process.filenames[idx],
+                                 *[f"{profile.get(k, 0.0):.6f}" for k in _PROFILE_STAGES],
+                                 *[profile.get(k, '') for k in _PROFILE_COUNTS]])
+        plt.figure(figsize=(10, 5))
+        x = np.array(frames) + 1
+        bottom = np.zeros(len(frames))
+        for stage in _PROFILE_STAGES:
+            y = np.array([self.profiles[idx].get(stage, 0.0) for idx in frames])
+            if np.any(y > 0):
+                plt.bar(x, y, bottom=bottom, label=stage)
+                bottom += y
+        plt.xlabel('frame')
+        plt.ylabel('time (s)')
+        plt.legend()
+        save_plot(f"{path}.pdf")
+        plt.close('all')
+        self.process.callback('save_plot', self.process.id, f"{self.process.name}: profile", f"{path}.pdf")
 
     def end(self):
+        if self.apply_cached_transforms:
+            with open(self.transforms_path(), 'w') as f:
+                json.dump({'config': self.transforms_config(), 'frames': self.transforms}, f, indent=1)
+        if self.plot_profile:
+            self.save_profile()
         if self.plot_summary:
             plt.figure(figsize=(10, 5))
             x = np.arange(1, len(self.n_matches) + 1, dtype=int)
@@ -286,10 +747,11 @@ class AlignFrames(SubAction):
             y_max = y[1] if self.process.ref_idx == 0 else y[-1] if self.process.ref_idx == len(y) - 1 else (y[self.process.ref_idx - 1] + y[self.process.ref_idx]) / 2 # noqa
 
             plt.plot([self.process.ref_idx + 1, self.process.ref_idx + 1], [0, y_max], color='cornflowerblue', linestyle='--', label='reference frame')
-            plt.plot([x[0], x[-1]], [self.min_matches, self.min_matches], color='lightgray', linestyle='--', label='min. matches')
-            plt.plot(x, y, color='navy', label='matches')
+            label = 'confidence' if self.phase_correlation else 'matches'
+            plt.plot([x[0], x[-1]], [self.min_matches, self.min_matches], color='lightgray', linestyle='--', label=f'min. {label}')
+            plt.plot(x, y, color='navy', label=label)
             plt.xlabel('frame')
-            plt.ylabel('# of matches')
+            plt.ylabel(label if self.phase_correlation else '# of matches')
             plt.legend()
             plt.ylim(0)
             plt.xlim(x[0], x[-1])
@@ -1,13 +1,15 @@
 import numpy as np
 import cv2
 import matplotlib.pyplot as plt
-from scipy.optimize import bisect
-from scipy.interpolate import interp1d
 from .. config.constants import constants
 from .. core.exceptions import InvalidOptionError
 from .utils import read_img, save_plot
 from .stack_framework import SubAction
 
+_BAND_ROWS = 128
+_GAMMA_RANGE = (0.1, 5)
+_GAMMA_MAX_ITERS = 50
+
 
 class CorrectionMapBase:
     def __init__(self, dtype, ref_hist, intensity_interval=None):
@@ -49,14 +51,13 @@ class MatchHist(CorrectionMapBase):
         CorrectionMapBase.__init__(self, dtype, ref_hist, intensity_interval)
         self.reference = self.cumsum(ref_hist)
         self.reference_mean = [r.mean() for r in self.reference]
-        self.values = [*range(self.num_pixel_values)]
+        self.values = np.arange(self.num_pixel_values, dtype=float)
 
     def cumsum(self, hist):
         return [np.cumsum(h) / h.sum() * self.max_pixel_value for h in hist]
 
     def lut(self, correction, reference):
-        interp = interp1d(reference, self.values)
-        lut = np.array([interp(v) for v in np.clip(correction, reference.min(), reference.max())])
+        lut = np.interp(np.clip(correction, reference.min(), reference.max()), reference, self.values)
         l0, l1 = lut[0], lut[-1]
         ll = lut[(lut != l0) & (lut != l1)]
         if ll.size > 0:
@@ -82,25 +83,59 @@ class CorrectionMap(CorrectionMapBase):
     def mid_val(self, lut, h):
         return np.average(lut[self.i_min:self.i_end], weights=h.flatten()[self.i_min:self.i_end])
 
+    def lut(self, correction, reference=None):
+        return self.map_values(np.arange(0, self.num_pixel_values), correction).astype(self.dtype)
+
+    def map_values(self, values, correction):
+        assert False, 'abstract method'
+
 
 class GammaMap(CorrectionMap):
     def __init__(self, dtype, ref_hist, intensity_interval=None):
         CorrectionMap.__init__(self, dtype, ref_hist, intensity_interval)
 
     def correction(self, hist):
-        return [bisect(lambda x: self.mid_val(self.lut(x), h) - r, 0.1, 5) for h, r in zip(hist, self.reference)]
-
-    def lut(self, correction, reference=None):
-        gamma_inv = 1.0 / correction
-        return (((np.arange(0, self.num_pixel_values) / self.max_pixel_value) ** gamma_inv) * self.max_pixel_value).astype(self.dtype)
+        corrections = []
+        for h, r in zip(hist, self.reference):
+            # only pixel values present in the histogram contribute to the mean
+            h = h.flatten()[self.i_min:self.i_end]
+            values = np.nonzero(h)[0] + self.i_min
+            weights = h[values - self.i_min]
+            # LUT values are truncated to integers, which lowers the mean by half a level on average
+            corrections.append(1.0 / self.exponent(values / self.max_pixel_value, weights / weights.sum(),
+                                                   (r + 0.5) / self.max_pixel_value))
+        return corrections
+
+    def exponent(self, x, w, target):
+        # solve sum(w * x^t) = target for t = 1 / gamma, the weighted mean is convex and decreasing in t
+        t_min, t_max = 1.0 / _GAMMA_RANGE[1], 1.0 / _GAMMA_RANGE[0]
+        x, w = x[x > 0], w[x > 0]
+        log_x = np.log(x)
+        mean = np.dot(w, x)
+        # exact if all pixels have the same value, refined by Newton steps on the mean of x^t
+        t = np.log(target) / np.log(mean) if 0 < mean < 1 and target > 0 else 1.0
+        t = np.clip(t, t_min, t_max)
+        for _ in range(_GAMMA_MAX_ITERS):
+            x_t = x ** t
+            slope = np.dot(w, x_t * log_x)
+            if slope == 0:
+                break
+            step = (np.dot(w, x_t) - target) / slope
+            t = np.clip(t - step, t_min, t_max)
+            if abs(step) < 1e-12:
+                break
+        return t
+
+    def map_values(self, values, correction):
+        return ((values / self.max_pixel_value) ** (1.0 / correction)) * self.max_pixel_value
 
 
 class LinearMap(CorrectionMap):
     def __init__(self, dtype, ref_hist, intensity_interval=None):
         CorrectionMap.__init__(self, dtype, ref_hist, intensity_interval)
 
-    def lut(self, correction, reference=None):
-        return np.clip(np.arange(0, self.num_pixel_values) * correction, 0, self.max_pixel_value).astype(self.dtype)
+    def map_values(self, values, correction):
+        return np.clip(values * correction, 0, self.max_pixel_value)
 
     def correction(self, hist):
         return [r / self.mid_val(self.id_lut, h) for h, r in zip(hist, self.reference)]
@@ -116,6 +151,7 @@ class Correction:
         self.subsample = constants.DEFAULT_BALANCE_SUBSAMPLE if subsample == -1 else subsample
         self.corr_map = corr_map
         self.channels = channels
+        self.masks = {}
 
     def begin(self, ref_image, size, ref_idx):
         self.dtype = ref_image.dtype
@@ -132,19 +168,36 @@ class Correction:
             raise InvalidOptionError("corr_map", self.corr_map)
         self.corrections = np.ones((size, self.channels))
 
-    def calc_hist_1ch(self, image):
+    def sample(self, image):
+        return image if self.subsample == 1 else image[::self.subsample, ::self.subsample]
+
+    def sample_mask(self, shape):
         if self.mask_size == 0:
-            image_sel = image
-        else:
-            height, width = image.shape[:2]
-            xv, yv = np.meshgrid(np.linspace(0, width - 1, width), np.linspace(0, height - 1, height))
-            mask_radius = (min(width, height) * self.mask_size / 2)
-            image_sel = image[(xv - width / 2) ** 2 + (yv - height / 2) ** 2 <= mask_radius ** 2]
-        hist, bins = np.histogram((image_sel if self.subsample == 1
-                                   else image_sel[::self.subsample, ::self.subsample]),
-                                  bins=np.linspace(-0.5, self.num_pixel_values - 0.5,
-                                                   self.num_pixel_values + 1))
-        return hist
+            return None
+        if shape[:2] not in self.masks:
+            height, width = shape[:2]
+            xs = np.arange(0, width, self.subsample) - width / 2
+            ys = np.arange(0, height, self.subsample) - height / 2
+            mask_radius = min(width, height) * self.mask_size / 2
+            self.masks[shape[:2]] = xs[np.newaxis, :] ** 2 + ys[:, np.newaxis] ** 2 <= mask_radius ** 2
+        return self.masks[shape[:2]]
+
+    def sampled_hist(self, sample, shape):
+        mask = self.sample_mask(shape)
+        pixels = sample if mask is None else sample[mask]
+        if sample.ndim == 2:
+            return [np.bincount(pixels.ravel(), minlength=self.num_pixel_values)]
+        # all channels in one pass, each channel counted in its own range of bins
+        channels = sample.shape[2]
+        offsets = np.arange(channels, dtype=np.int32) * self.num_pixel_values
+        hist = np.bincount((pixels.reshape(-1, channels) + offsets).ravel(), minlength=channels * self.num_pixel_values)
+        return list(hist.reshape(channels, self.num_pixel_values))
+
+    def calc_hist(self, image):
+        return self.sampled_hist(self.sample(image), image.shape)
+
+    def calc_hist_1ch(self, image):
+        return self.calc_hist(image)[0]
 
     def balance(self, image, idx):
         correction = self.corr_map.correction(self.get_hist(image, idx))
@@ -195,14 +248,13 @@ class LumiCorrection(Correction):
         Correction.__init__(self, 1, **kwargs)
 
     def get_hist(self, image, idx):
-        hist = self.calc_hist_1ch(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
-        chans = cv2.split(image)
+        sample = self.sample(image)
+        hist = self.sampled_hist(cv2.cvtColor(sample, cv2.COLOR_BGR2GRAY), image.shape)[0]
         colors = ("r", "g", "b")
         if self.plot_histograms:
             fig, axs = plt.subplots(1, 2, figsize=(10, 5), sharey=True)
             self.histo_plot(axs[0], hist, "pixel luminosity", 'black')
-            for (chan, color) in zip(chans, colors):
-                hist_col = self.calc_hist_1ch(chan)
+            for (hist_col, color) in zip(self.sampled_hist(sample, image.shape), colors):
                 self.histo_plot(axs[1], hist_col, "r,g,b luminosity", color, alpha=0.5)
             plt.xlim(0, self.max_pixel_value)
             self.save_plot(idx)
@@ -229,7 +281,7 @@ class RGBCorrection(Correction):
         Correction.__init__(self, 3, **kwargs)
 
     def get_hist(self, image, idx):
-        hist = [self.calc_hist_1ch(chan) for chan in cv2.split(image)]
+        hist = self.calc_hist(image)
         colors = ("r", "g", "b")
         if self.plot_histograms:
             fig, axs = plt.subplots(1, 3, figsize=(10, 5), sharey=True)
@@ -261,14 +313,36 @@ class Ch2Correction(Correction):
     def __init__(self, **kwargs):
         Correction.__init__(self, 2, **kwargs)
 
-    def preprocess(self, image):
-        assert False, 'abstract method'
-
     def get_labels(self):
         assert False, 'abstract method'
 
+    def convert(self, image):
+        if image.dtype == np.uint8:
+            return cv2.cvtColor(image, self.to_space)
+        # OpenCV converts 16-bit images only as floats: hue in [0, 360), other channels in [0, 1]
+        converted = cv2.cvtColor(image.astype(np.float32) / self.max_pixel_value, self.to_space)
+        converted[:, :, 0] /= 360
+        return np.round(converted * self.max_pixel_value).astype(image.dtype)
+
+    def convert_back(self, image):
+        if image.dtype == np.uint8:
+            return cv2.cvtColor(image, self.from_space)
+        converted = image.astype(np.float32) / self.max_pixel_value
+        converted[:, :, 0] *= 360
+        converted = cv2.cvtColor(converted, self.from_space) * self.max_pixel_value
+        return np.round(np.clip(converted, 0, self.max_pixel_value)).astype(image.dtype)
+
+    def balance(self, image, idx):
+        correction = self.corr_map.correction(self.get_hist(image, idx))
+        # convert, correct and convert back one band of rows at a time, the full frame is never converted at once
+        balanced = np.empty_like(image)
+        for y in range(0, image.shape[0], _BAND_ROWS):
+            band = self.convert(image[y:y + _BAND_ROWS])
+            balanced[y:y + _BAND_ROWS] = self.convert_back(self.corr_map.adjust(band, correction))
+        return correction, balanced
+
     def get_hist(self, image, idx):
-        hist = [self.calc_hist_1ch(chan) for chan in cv2.split(image)]
+        hist = self.sampled_hist(self.convert(self.sample(image)), image.shape)
         if self.plot_histograms:
             fig, axs = plt.subplots(1, 3, figsize=(10, 5), sharey=True)
             for c in range(3):
@@ -298,27 +372,17 @@ class SVCorrection(Ch2Correction):
     def __init__(self, **kwargs):
         Ch2Correction.__init__(self, **kwargs)
         self.labels = ("H", "S", "V")
+        self.to_space, self.from_space = cv2.COLOR_BGR2HSV, cv2.COLOR_HSV2BGR
         self.colors = ("hotpink", "orange", "navy")
 
-    def preprocess(self, image):
-        return cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-
-    def postprocess(self, image):
-        return cv2.cvtColor(image, cv2.COLOR_HSV2BGR)
-
 
 class LSCorrection(Ch2Correction):
     def __init__(self, **kwargs):
         Ch2Correction.__init__(self, **kwargs)
         self.labels = ("H", "L", "S")
+        self.to_space, self.from_space = cv2.COLOR_BGR2HLS, cv2.COLOR_HLS2BGR
         self.colors = ("hotpink", "navy", "orange")
 
-    def preprocess(self, image):
-        return cv2.cvtColor(image, cv2.COLOR_BGR2HLS)
-
-    def postprocess(self, image):
-        return cv2.cvtColor(image, cv2.COLOR_HLS2BGR)
-
 
 class BalanceFrames(SubAction):
     def __init__(self, enabled=True, **kwargs):
@@ -360,6 +424,12 @@ class BalanceFrames(SubAction):
             plt.imshow(img, 'gray')
             self.correction.save_summary_plot("mask")
 
+    def frame_results(self, idx):
+        return self.correction.corrections[idx]
+
+    def set_frame_results(self, idx, results):
+        self.correction.corrections[idx] = results
+
     def run_frame(self, idx, ref_idx, image):
         if idx != self.process.ref_idx:
             self.process.sub_message_r(': balance image')
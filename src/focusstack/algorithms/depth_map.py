@@ -1,3 +1,8 @@
+import os
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2
 from .. config.constants import constants
@@ -10,7 +15,10 @@ class DepthMapStack:
     def __init__(self, map_type=constants.DEFAULT_DM_MAP, energy=constants.DEFAULT_DM_ENERGY,
                  kernel_size=constants.DEFAULT_DM_KERNEL_SIZE, blur_size=constants.DEFAULT_DM_BLUR_SIZE,
                  smooth_size=constants.DEFAULT_DM_SMOOTH_SIZE, temperature=constants.DEFAULT_DM_TEMPERATURE,
-                 levels=constants.DEFAULT_DM_LEVELS, float_type=constants.DEFAULT_DM_FLOAT):
+                 levels=constants.DEFAULT_DM_LEVELS, float_type=constants.DEFAULT_DM_FLOAT,
+                 frame_cache=constants.DEFAULT_DM_CACHE, cache_size=constants.DEFAULT_DM_CACHE_SIZE,
+                 energy_volume=constants.DEFAULT_DM_VOLUME, max_threads=constants.DEFAULT_DM_MAX_THREADS,
+                 energy_downsample=constants.DEFAULT_DM_ENERGY_DOWNSAMPLE):
         self.map_type = map_type
         self.energy = energy
         self.kernel_size = kernel_size
@@ -18,6 +26,19 @@ class DepthMapStack:
         self.smooth_size = smooth_size
         self.temperature = temperature
         self.levels = levels
+        if frame_cache not in constants.VALID_DM_CACHE:
+            raise InvalidOptionError("frame_cache", frame_cache,
+                                     details=f" valid values are {', '.join(constants.VALID_DM_CACHE)}")
+        self.frame_cache = frame_cache
+        self.cache_size = cache_size
+        if energy_volume not in constants.VALID_DM_VOLUME:
+            raise InvalidOptionError("energy_volume", energy_volume,
+                                     details=f" valid values are {', '.join(constants.VALID_DM_VOLUME)}")
+        self.energy_volume = energy_volume
+        self.max_threads = max(1, min(max_threads, os.cpu_count() or 1))
+        if energy_downsample < 1:
+            raise InvalidOptionError("energy_downsample", energy_downsample, details=" downsampling factor must be at least 1")
+        self.energy_downsample = energy_downsample
         if float_type == constants.FLOAT_32:
             self.float_type = np.float32
         elif float_type == constants.FLOAT_64:
@@ -34,67 +55,165 @@ class DepthMapStack:
     def print_message(self, msg):
         self.process.sub_message_r(color_str(msg, "light_blue"))
 
-    def get_sobel_map(self, gray_images):
-        energies = np.zeros(gray_images.shape, dtype=self.float_type)
-        for i in range(gray_images.shape[0]):
-            img = gray_images[i]
-            energies[i] = np.abs(cv2.Sobel(img, cv2.CV_64F, 1, 0, ksize=3)) + \
-                np.abs(cv2.Sobel(img, cv2.CV_64F, 0, 1, ksize=3))
-        return energies
-
-    def get_laplacian_map(self, gray_images):
-        laplacian = np.zeros(gray_images.shape, dtype=self.float_type)
-        for i in range(gray_images.shape[0]):
-            blurred = cv2.GaussianBlur(gray_images[i], (self.blur_size, self.blur_size), 0)
-            laplacian[i] = np.abs(cv2.Laplacian(blurred, cv2.CV_64F, ksize=self.kernel_size))
-        return laplacian
-
-    def smooth_energy(self, energy_map):
-        if self.smooth_size <= 0:
-            return energy_map
-        smoothed = np.zeros(energy_map.shape, dtype=np.float32)
-        for i in range(energy_map.shape[0]):
-            energy_32f = energy_map[i].astype(np.float32)
-            smoothed_32f = cv2.bilateralFilter(energy_32f, self.smooth_size, 25, 25)
-            smoothed[i] = smoothed_32f.astype(energy_map.dtype)
-        return smoothed
-
-    def get_focus_map(self, energies):
+    def begin_cache(self, n_frames):
+        self.cached_frames = [None] * n_frames
+        self.cache_bytes = 0
+        self.scratch_dir = None
+
+    def scratch_array(self, name, shape, dtype):
+        if self.scratch_dir is None:
+            self.scratch_dir = tempfile.mkdtemp(prefix='focusstack-')
+        path = os.path.join(self.scratch_dir, f"{name}.npy")
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+    def cache_frame(self, i, img):
+        if self.frame_cache == constants.DM_CACHE_NONE or self.cache_bytes + img.nbytes > self.cache_size * 2 ** 20:
+            return
+        if self.frame_cache == constants.DM_CACHE_MMAP:
+            frame = self.scratch_array(f"frame-{i:04d}", img.shape, img.dtype)
+            path = frame.filename
+            frame[:] = img
+            frame.flush()
+            del frame
+            self.cached_frames[i] = np.load(path, mmap_mode='r')
+        else:
+            self.cached_frames[i] = img
+        self.cache_bytes += img.nbytes
+
+    def read_frame(self, i, img_path):
+        img, self.cached_frames[i] = self.cached_frames[i], None
+        if img is None:
+            self.print_message(': reading file (2/2) {}'.format(img_path.split('/')[-1]))
+            return read_img(img_path)
+        self.print_message(': cached file (2/2) {}'.format(img_path.split('/')[-1]))
+        return img
+
+    def end_cache(self):
+        self.cached_frames = None
+        if self.scratch_dir is not None:
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
+            self.scratch_dir = None
+
+    def new_volume(self, name, shape, dtype):
+        if self.energy_volume == constants.DM_VOLUME_MMAP:
+            return self.scratch_array(name, shape, dtype)
+        return np.empty(shape, dtype=dtype)
+
+    def process_frames(self, items, function):
+        if self.max_threads == 1:
+            for item in items:
+                yield item, function(item)
+            return
+        with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
+            pending = deque()
+            try:
+                for item in items:
+                    pending.append((item, executor.submit(function, item)))
+                    if len(pending) > self.max_threads:
+                        item, future = pending.popleft()
+                        yield item, future.result()
+                while len(pending) > 0:
+                    item, future = pending.popleft()
+                    yield item, future.result()
+            finally:
+                for _, future in pending:
+                    future.cancel()
+
+    def get_sobel_map(self, gray):
+        return np.abs(cv2.Sobel(gray, cv2.CV_64F, 1, 0, ksize=3)) + \
+            np.abs(cv2.Sobel(gray, cv2.CV_64F, 0, 1, ksize=3))
+
+    def get_laplacian_map(self, gray):
+        blurred = cv2.GaussianBlur(gray, (self.blur_size, self.blur_size), 0)
+        return np.abs(cv2.Laplacian(blurred, cv2.CV_64F, ksize=self.kernel_size))
+
+    def get_energy(self, gray):
+        gray = gray.astype(self.float_type)
+        if self.energy_downsample > 1:
+            size = (max(1, gray.shape[1] // self.energy_downsample), max(1, gray.shape[0] // self.energy_downsample))
+            gray = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+        if self.energy == constants.DM_ENERGY_SOBEL:
+            return self.get_sobel_map(gray)
+        elif self.energy == constants.DM_ENERGY_LAPLACIAN:
+            return self.get_laplacian_map(gray)
+        else:
+            raise InvalidOptionError('energy', self.energy, details=f" valid values are "
+                                     f"{constants.DM_ENERGY_SOBEL} and {constants.DM_ENERGY_LAPLACIAN}.")
+
+    def load_frame(self, img_path):
+        img = read_img(img_path)
+        if img is None:
+            raise ImageLoadError(img_path)
+        return img, self.get_energy(img_bw(img))
+
+    def smooth_energy(self, energy):
+        smooth_size = max(1, self.smooth_size // self.energy_downsample)
+        return cv2.bilateralFilter(energy.astype(np.float32), smooth_size, 25, 25)
+
+    def normalise_energy(self, energy, max_energy):
+        if max_energy > 0:
+            energy = energy / max_energy
+        return self.smooth_energy(energy) if self.smooth_size > 0 else energy
+
+    def normalise_energies(self, energies, max_energy):
+        if self.smooth_size > 0 and energies.dtype != np.float32:
+            normalised = self.new_volume('normalised', energies.shape, np.float32)
+        else:
+            normalised = energies
+        for i, energy in self.process_frames(range(energies.shape[0]),
+                                             lambda i: self.normalise_energy(energies[i], max_energy)):
+            normalised[i] = energy
+        return normalised
+
+    def get_focus_stats(self, energies):
         if self.map_type == constants.DM_MAP_AVERAGE:
-            sum_energies = np.sum(energies, axis=0)
-            return np.divide(energies, sum_energies, where=sum_energies != 0)
+            sum_energies = np.array(energies[0])
+            for i in range(1, energies.shape[0]):
+                sum_energies += energies[i]
+            return sum_energies,
         elif self.map_type == constants.DM_MAP_MAX:
-            max_energy = np.max(energies, axis=0)
-            relative = np.exp((energies - max_energy) / self.temperature)
-            return relative / np.sum(relative, axis=0)
+            max_energy = np.array(energies[0])
+            for i in range(1, energies.shape[0]):
+                np.maximum(max_energy, energies[i], out=max_energy)
+            sum_relative = np.zeros_like(max_energy)
+            for i in range(energies.shape[0]):
+                sum_relative += np.exp((energies[i] - max_energy) / self.temperature)
+            return max_energy, sum_relative
         else:
             raise InvalidOptionError("map_type", self.map_type, details=f" valid values are "
                                      f"{constants.DM_MAP_AVERAGE} and {constants.DM_MAP_MAX}.")
 
-    def pyramid_blend(self, images, weights):
-        blended = None
-        for i in range(images.shape[0]):
-            img = images[i].astype(self.float_type)
-            weight = weights[i]
-            gp_img = [img]
-            gp_weight = [weight]
-            for _ in range(self.levels - 1):
-                gp_img.append(cv2.pyrDown(gp_img[-1]))
-                gp_weight.append(cv2.pyrDown(gp_weight[-1]))
-            lp_img = [gp_img[-1]]
-            for j in range(self.levels - 1, 0, -1):
-                size = (gp_img[j - 1].shape[1], gp_img[j - 1].shape[0])
-                expanded = cv2.pyrUp(gp_img[j], dstsize=size)
-                lp_img.append(gp_img[j - 1] - expanded)
-            current_blend = []
-            for j in range(self.levels):
-                w = gp_weight[self.levels - 1 - j][..., np.newaxis]
-                current_blend.append(lp_img[j] * w)
-            if blended is None:
-                blended = current_blend
-            else:
-                for j in range(self.levels):
-                    blended[j] += current_blend[j]
+    def get_focus_map(self, energy, stats, shape):
+        if self.map_type == constants.DM_MAP_AVERAGE:
+            sum_energies, = stats
+            weight = np.divide(energy, sum_energies, out=np.zeros_like(sum_energies), where=sum_energies != 0)
+        else:
+            max_energy, sum_relative = stats
+            weight = np.exp((energy - max_energy) / self.temperature) / sum_relative
+        if weight.shape != shape:
+            weight = cv2.resize(weight, (shape[1], shape[0]), interpolation=cv2.INTER_LINEAR)
+        return weight
+
+    def blend_frame(self, img, weight, blended):
+        # adds the Laplacian pyramid of the frame, weighted by the Gaussian pyramid of its focus map
+        gp_img = [img]
+        gp_weight = [weight]
+        for _ in range(self.levels - 1):
+            gp_img.append(cv2.pyrDown(gp_img[-1]))
+            gp_weight.append(cv2.pyrDown(gp_weight[-1]))
+        lp_img = [gp_img[-1]]
+        for j in range(self.levels - 1, 0, -1):
+            size = (gp_img[j - 1].shape[1], gp_img[j - 1].shape[0])
+            expanded = cv2.pyrUp(gp_img[j], dstsize=size)
+            lp_img.append(gp_img[j - 1] - expanded)
+        current_blend = [lp_img[j] * gp_weight[self.levels - 1 - j][..., np.newaxis] for j in range(self.levels)]
+        if blended is None:
+            return current_blend
+        for j in range(self.levels):
+            blended[j] += current_blend[j]
+        return blended
+
+    def collapse(self, blended):
         result = blended[0]
         for j in range(1, self.levels):
             size = (blended[j].shape[1], blended[j].shape[0])
@@ -102,63 +221,43 @@ class DepthMapStack:
         return result
 
     def focus_stack(self, filenames):
-        gray_images = []
+        self.begin_cache(len(filenames))
+        try:
+            return self.focus_stack_frames(filenames)
+        finally:
+            self.end_cache()
+
+    def focus_stack_frames(self, filenames):
+        energies = None
+        max_energy = None
         metadata = None
-        for i, img_path in enumerate(filenames):
+        # frames may be loaded by worker threads, messages are printed here in frame order
+        for i, (img_path, (img, energy)) in enumerate(self.process_frames(filenames, self.load_frame)):
             self.print_message(': reading file (1/2) {}'.format(img_path.split('/')[-1]))
-            img = read_img(img_path)
-            if img is None:
-                raise ImageLoadError(img_path)
             if metadata is None:
                 metadata = get_img_metadata(img)
+                energies = self.new_volume('energies', (len(filenames), *energy.shape), self.float_type)
             else:
                 validate_image(img, *metadata)
-            gray = img_bw(img)
-            gray_images.append(gray)
+            energies[i] = energy
+            frame_max = np.max(energies[i])
+            max_energy = frame_max if max_energy is None else max(max_energy, frame_max)
+            self.cache_frame(i, img)
             self.process.callback('after_step', self.process.id, self.process.name, i)
             if self.process.callback('check_running', self.process.id, self.process.name) is False:
                 raise RunStopException(self.name)
         dtype = metadata[1]
-        gray_images = np.array(gray_images, dtype=self.float_type)
-        if self.energy == constants.DM_ENERGY_SOBEL:
-            energies = self.get_sobel_map(gray_images)
-        elif self.energy == constants.DM_ENERGY_LAPLACIAN:
-            energies = self.get_laplacian_map(gray_images)
-        else:
-            raise InvalidOptionError('energy', self.energy, details=f" valid values are "
-                                     f"{constants.DM_ENERGY_SOBEL} and {constants.DM_ENERGY_LAPLACIAN}.")
-        max_energy = np.max(energies)
-        if max_energy > 0:
-            energies = energies / max_energy
-        if self.smooth_size > 0:
-            energies = self.smooth_energy(energies)
-        weights = self.get_focus_map(energies)
+        energies = self.normalise_energies(energies, max_energy)
+        stats = self.get_focus_stats(energies)
         blended_pyramid = None
         for i, img_path in enumerate(filenames):
-            self.print_message(': reading file (2/2) {}'.format(img_path.split('/')[-1]))
-            img = read_img(img_path).astype(self.float_type)
-            weight = weights[i]
-            gp_img = [img]
-            gp_weight = [weight]
-            for _ in range(self.levels - 1):
-                gp_img.append(cv2.pyrDown(gp_img[-1]))
-                gp_weight.append(cv2.pyrDown(gp_weight[-1]))
-            lp_img = [gp_img[-1]]
-            for j in range(self.levels - 1, 0, -1):
-                size = (gp_img[j - 1].shape[1], gp_img[j - 1].shape[0])
-                expanded = cv2.pyrUp(gp_img[j], dstsize=size)
-                lp_img.append(gp_img[j - 1] - expanded)
-            current_blend = [lp_img[j] * gp_weight[self.levels - 1 - j][..., np.newaxis]
-                             for j in range(self.levels)]
-            blended_pyramid = current_blend if blended_pyramid is None \
-                else [np.add(bp, cb) for bp, cb in zip(blended_pyramid, current_blend)]
+            img = self.read_frame(i, img_path).astype(self.float_type)
+            weight = self.get_focus_map(energies[i], stats, img.shape[:2])
+            blended_pyramid = self.blend_frame(img, weight, blended_pyramid)
             self.process.callback('after_step', self.process.id, self.process.name, i + len(filenames))
             if self.process.callback('check_running', self.process.id, self.process.name) is False:
                 raise RunStopException(self.name)
-        result = blended_pyramid[0]
         self.print_message(': blend levels')
-        for j in range(1, self.levels):
-            size = (blended_pyramid[j].shape[1], blended_pyramid[j].shape[0])
-            result = cv2.pyrUp(result, dstsize=size) + blended_pyramid[j]
+        result = self.collapse(blended_pyramid)
         n_values = 255 if dtype == np.uint8 else 65535
         return np.clip(np.absolute(result), 0, n_values).astype(dtype)
@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+
+_active_cache = None
+
+
+def get_frame_cache():
+    return _active_cache
+
+
+def set_frame_cache(cache):
+    global _active_cache
+    previous, _active_cache = _active_cache, cache
+    return previous
+
+
+def file_key(file_path):
+    stat = os.stat(file_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class FrameCache:
+    def __init__(self, max_size, spill=False):
+        self.max_bytes = max_size * 2 ** 20
+        self.spill = spill
+        self.frames = OrderedDict()
+        self.spilled = {}
+        self.memory_bytes = 0
+        self.peak_bytes = 0
+        self.scratch_dir = None
+        self.hits, self.disk_hits, self.misses, self.evictions = 0, 0, 0, 0
+        self.spill_count = 0
+        self.lock = threading.Lock()
+
+    def get(self, file_path):
+        path = os.path.abspath(file_path)
+        key = file_key(path)
+        with self.lock:
+            entry = self.frames.get(path)
+            if entry is not None and entry[0] == key:
+                self.frames.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            entry = self.spilled.get(path)
+            if entry is not None and entry[0] == key:
+                img = np.load(entry[1])
+                self.disk_hits += 1
+                self.store(path, key, img)
+                return img
+            self.misses += 1
+            return None
+
+    def put(self, file_path, img):
+        if img.nbytes > self.max_bytes:
+            return
+        path = os.path.abspath(file_path)
+        with self.lock:
+            self.store(path, file_key(path), img)
+
+    def store(self, path, key, img):
+        self.remove(path)
+        img.flags.writeable = False
+        self.frames[path] = (key, img)
+        self.memory_bytes += img.nbytes
+        while self.memory_bytes > self.max_bytes:
+            self.evict()
+        self.peak_bytes = max(self.peak_bytes, self.memory_bytes)
+
+    def evict(self):
+        path, (key, img) = self.frames.popitem(last=False)
+        self.memory_bytes -= img.nbytes
+        self.evictions += 1
+        if self.spill:
+            if self.scratch_dir is None:
+                self.scratch_dir = tempfile.mkdtemp(prefix='focusstack-')
+            spill_path = os.path.join(self.scratch_dir, f"frame-{self.spill_count:05d}.npy")
+            self.spill_count += 1
+            np.save(spill_path, img)
+            self.spilled[path] = (key, spill_path)
+
+    def remove(self, path):
+        entry = self.frames.pop(path, None)
+        if entry is not None:
+            self.memory_bytes -= entry[1].nbytes
+        entry = self.spilled.pop(path, None)
+        if entry is not None:
+            os.remove(entry[1])
+
+    def invalidate(self, file_path):
+        with self.lock:
+            self.remove(os.path.abspath(file_path))
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.spilled.clear()
+            self.memory_bytes = 0
+            if self.scratch_dir is not None:
+                shutil.rmtree(self.scratch_dir, ignore_errors=True)
+                self.scratch_dir = None
+
+    def stats_str(self):
+        return f"{self.hits + self.disk_hits} hits ({self.disk_hits} from disk), {self.misses} misses, " \
+               f"{self.evictions} evictions, peak memory {self.peak_bytes / 2 ** 20:.1f} MB"
@@ -7,15 +7,13 @@ import errno
 from .. config.config import config
 from .. config.constants import constants
 from .. core.colors import color_str
-from .. core.exceptions import ImageLoadError
+from .. core.exceptions import ImageLoadError, ShapeError
 from .. core.framework import JobBase
 from .. core.core_utils import make_tqdm_bar
 from .. core.exceptions import RunStopException
 from .stack_framework import FrameMultiDirectory, SubAction
 from .utils import read_img, save_plot, get_img_metadata, validate_image
 
-MAX_NOISY_PIXELS = 1000
-
 
 def mean_image(file_paths, max_frames=-1, message_callback=None, progress_callback=None):
     mean_img = None
@@ -148,35 +146,48 @@ class MaskNoise(SubAction):
                 raise ImageLoadError(path, f"failed to load image file {self.noise_mask}.")
         else:
             raise ImageLoadError(path, "file not found.")
+        self.gather_table()
+
+    def gather_table(self):
+        # flat indices of the kernel_size x kernel_size neighbourhood of each noisy pixel,
+        # neighbours falling outside the frame are flagged and replaced by the pixel itself
+        h, w = self.noise_mask_img.shape
+        ys, xs = np.nonzero(self.noise_mask_img > 0)
+        offsets = np.arange(-self.ks2, self.ks2_1)
+        ny = ys[:, np.newaxis] + np.repeat(offsets, len(offsets))[np.newaxis, :]
+        nx = xs[:, np.newaxis] + np.tile(offsets, len(offsets))[np.newaxis, :]
+        self.inside = (ny >= 0) & (ny < h) & (nx >= 0) & (nx < w)
+        self.noisy_pixels = ys * w + xs
+        self.neighbours = np.where(self.inside, ny * w + nx, self.noisy_pixels[:, np.newaxis])
 
     def end(self):
         pass
 
     def run_frame(self, idx, ref_idx, image):
         self.process.sub_message_r(': mask noisy pixels')
-        if len(image.shape) == 3:
-            corrected = image.copy()
-            for c in range(3):
-                corrected[:, :, c] = self.correct_channel(image[:, :, c])
+        if image.shape[:2] != self.noise_mask_img.shape:
+            raise ShapeError(self.noise_mask_img.shape, image.shape[:2])
+        corrected = image.copy()
+        if len(self.noisy_pixels) == 0:
+            return corrected
+        pixels = image.reshape(-1, image.shape[2] if len(image.shape) == 3 else 1)
+        # gather: (noisy pixels, neighbours, channels), all channels at once
+        neighbourhood = pixels[self.neighbours]
+        valid = self.inside[:, :, np.newaxis] & (neighbourhood != 0)
+        counts = np.count_nonzero(valid, axis=1)
+        if self.method == constants.INTERPOLATE_MEAN:
+            sums = np.where(valid, neighbourhood, 0).sum(axis=1, dtype=np.float64)
+            values = sums / np.maximum(counts, 1)
+        elif self.method == constants.INTERPOLATE_MEDIAN:
+            # invalid neighbours sort last, the median is taken among the first counts values
+            ordered = np.sort(np.where(valid, neighbourhood, np.inf), axis=1)
+            lower = np.take_along_axis(ordered, np.maximum(counts - 1, 0)[:, np.newaxis, :] // 2, axis=1)[:, 0]
+            upper = np.take_along_axis(ordered, counts[:, np.newaxis, :] // 2, axis=1)[:, 0]
+            values = np.where(counts > 0, (lower + upper) / 2, 0)
         else:
-            corrected = self.correct_channel(image)
-        return corrected
-
-    def correct_channel(self, channel):
-        corrected = channel.copy()
-        noise_coords = np.argwhere(self.noise_mask_img > 0)
-        n_noisy_pixels = noise_coords.shape[0]
-        if n_noisy_pixels > MAX_NOISY_PIXELS:
-            raise RuntimeError(f"Noise map contains too many hot pixels: {n_noisy_pixels}")
-        for y, x in noise_coords:
-            neighborhood = channel[
-                max(0, y - self.ks2):min(channel.shape[0], y + self.ks2_1),
-                max(0, x - self.ks2):min(channel.shape[1], x + self.ks2_1)
-            ]
-            valid_pixels = neighborhood[neighborhood != 0]
-            if len(valid_pixels) > 0:
-                if self.method == constants.INTERPOLATE_MEAN:
-                    corrected[y, x] = np.mean(valid_pixels)
-                elif self.method == constants.INTERPOLATE_MEDIAN:
-                    corrected[y, x] = np.median(valid_pixels)
+            return corrected
+        # scatter: noisy pixels without valid neighbours are left unchanged
+        corrected_pixels = corrected.reshape(pixels.shape)
+        original = pixels[self.noisy_pixels]
+        corrected_pixels[self.noisy_pixels] = np.where(counts > 0, values.astype(image.dtype), original)
         return corrected
@@ -1,3 +1,9 @@
+import os
+import shutil
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2
 from .. config.constants import constants
@@ -12,9 +18,12 @@ class PyramidBase:
         self.min_size = min_size
         self.kernel_size = kernel_size
         self.pad_amount = (kernel_size - 1) // 2
+        self.box_kernel = np.ones((2 * self.pad_amount + 1, 2 * self.pad_amount + 1))
         self.do_step_callback = False
         kernel = np.array([0.25 - gen_kernel / 2.0, 0.25, gen_kernel, 0.25, 0.25 - gen_kernel / 2.0])
         self.gen_kernel = np.outer(kernel, kernel)
+        self.expand_kernel = 4. * self.gen_kernel
+        self.local_buffers = threading.local()
         if float_type == constants.FLOAT_32:
             self.float_type = np.float32
         elif float_type == constants.FLOAT_64:
@@ -28,32 +37,47 @@ class PyramidBase:
     def steps_per_frame(self):
         return 1
 
+    def set_metadata(self, img):
+        metadata = get_img_metadata(img)
+        self.dtype = metadata[1]
+        self.num_pixel_values = constants.NUM_UINT8 if self.dtype == np.uint8 else constants.NUM_UINT16
+        self.max_pixel_value = constants.MAX_UINT8 if self.dtype == np.uint8 else constants.MAX_UINT16
+        return metadata
+
     def convolve(self, image):
         return cv2.filter2D(image, -1, self.gen_kernel, borderType=cv2.BORDER_REFLECT101)
 
+    def get_buffer(self, tag, shape, dtype):
+        buffers = getattr(self.local_buffers, 'buffers', None)
+        if buffers is None:
+            buffers = self.local_buffers.buffers = {}
+        key = (tag, shape, np.dtype(dtype))
+        if key not in buffers:
+            buffers[key] = np.zeros(shape, dtype=dtype)
+        return buffers[key]
+
+    def release_buffers(self):
+        self.local_buffers = threading.local()
+
     def reduce_layer(self, layer):
-        if len(layer.shape) == 2:
-            return self.convolve(layer)[::2, ::2]
-        reduced_channels = [self.reduce_layer(layer[:, :, channel]) for channel in range(layer.shape[2])]
-        return np.stack(reduced_channels, axis=-1)
+        convolved = cv2.filter2D(layer, -1, self.gen_kernel, dst=self.get_buffer('reduce', layer.shape, layer.dtype),
+                                 borderType=cv2.BORDER_REFLECT101)
+        return convolved[::2, ::2].copy()
 
     def expand_layer(self, layer):
-        if len(layer.shape) == 2:
-            expand = np.empty((2 * layer.shape[0], 2 * layer.shape[1]), dtype=layer.dtype)
-            expand[::2, ::2] = layer
-            expand[1::2, :] = 0
-            expand[:, 1::2] = 0
-            return 4. * self.convolve(expand)
-        ch_layer = self.expand_layer(layer[:, :, 0])
-        next_layer = np.zeros(list(ch_layer.shape) + [layer.shape[2]], dtype=layer.dtype)
-        next_layer[:, :, 0] = ch_layer
-        for channel in range(1, layer.shape[2]):
-            next_layer[:, :, channel] = self.expand_layer(layer[:, :, channel])
-        return next_layer
+        # the returned array is a per-thread buffer, reused by the next call with the same shape
+        shape = (2 * layer.shape[0], 2 * layer.shape[1]) + layer.shape[2:]
+        upsampled = self.get_buffer('upsample', shape, layer.dtype)
+        upsampled[::2, ::2] = layer
+        return cv2.filter2D(upsampled, -1, self.expand_kernel, dst=self.get_buffer('expand', shape, layer.dtype),
+                            borderType=cv2.BORDER_REFLECT101)
+
+    def energy(self, laplacian):
+        gray_lap = cv2.cvtColor(laplacian.astype(np.float32), cv2.COLOR_BGR2GRAY)
+        return self.convolve(np.square(gray_lap))
 
     def fuse_laplacian(self, laplacians):
-        gray_laps = [cv2.cvtColor(lap.astype(np.float32), cv2.COLOR_BGR2GRAY) for lap in laplacians]
-        energies = [self.convolve(np.square(gray_lap)) for gray_lap in gray_laps]
+        energies = [self.energy(lap) for lap in laplacians]
         best = np.argmax(energies, axis=0)
         fused = np.zeros_like(laplacians[0])
         for i, lap in enumerate(laplacians):
@@ -69,38 +93,27 @@ class PyramidBase:
             img = expanded + layer
         return np.clip(np.abs(img), 0, self.max_pixel_value)
 
+    def box_sum(self, image):
+        return cv2.filter2D(image.astype(np.float64), cv2.CV_64F, self.box_kernel, borderType=cv2.BORDER_REFLECT101)
+
     def entropy(self, image):
-        levels, counts = np.unique(image.astype(self.dtype), return_counts=True)
-        probabilities = np.zeros((self.num_pixel_values), dtype=self.float_type)
+        levels, counts = np.unique(image, return_counts=True)
+        probabilities = np.ones((self.num_pixel_values), dtype=self.float_type)
         probabilities[levels] = counts.astype(self.float_type) / counts.sum()
-        padded_image = cv2.copyMakeBorder(image, self.pad_amount, self.pad_amount, self.pad_amount,
-                                          self.pad_amount, cv2.BORDER_REFLECT101)
-        return np.fromfunction(np.vectorize(lambda row, column: self.area_entropy(
-            self.get_pad(padded_image, row, column), probabilities)), image.shape[:2], dtype=int)
-
-    def area_entropy(self, area, probabilities):
-        levels = area.flatten()
-        return self.float_type(-1. * (levels * np.log(probabilities[levels])).sum())
-
-    def get_pad(self, padded_image, row, column):
-        return padded_image[row + self.pad_amount + self.offset[:, np.newaxis], column + self.pad_amount + self.offset]
-
-    def area_deviation(self, area):
-        return np.square(area - np.average(area).astype(self.float_type)).sum() / area.size
+        return (-self.box_sum(image * np.log(probabilities)[image])).astype(self.float_type)
 
     def deviation(self, image):
-        padded_image = cv2.copyMakeBorder(image, self.pad_amount, self.pad_amount, self.pad_amount,
-                                          self.pad_amount, cv2.BORDER_REFLECT101)
-        return np.fromfunction(
-            np.vectorize(lambda row, column: self.area_deviation(self.get_pad(padded_image, row, column))),
-            image.shape[:2], dtype=int)
+        area_size = self.box_kernel.size
+        pixel_sum = self.box_sum(image)
+        square_sum = self.box_sum(np.square(image.astype(np.float64)))
+        return ((area_size * square_sum - np.square(pixel_sum)) / area_size ** 2).astype(self.float_type)
+
+    def gray_base(self, image):
+        return cv2.cvtColor(image.astype(np.float32), cv2.COLOR_BGR2GRAY).astype(self.dtype)
 
     def get_fused_base(self, images):
-        layers, height, width, _ = images.shape
-        entropies = np.zeros(images.shape[:3], dtype=self.float_type)
-        deviations = np.copy(entropies)
-        gray_images = np.array([cv2.cvtColor(images[layer].astype(np.float32),
-                                             cv2.COLOR_BGR2GRAY).astype(self.dtype) for layer in range(layers)])
+        layers = images.shape[0]
+        gray_images = np.array([self.gray_base(images[layer]) for layer in range(layers)])
         entropies = np.array([self.entropy(img) for img in gray_images])
         deviations = np.array([self.deviation(img) for img in gray_images])
         best_e = np.argmax(entropies, axis=0)
@@ -115,9 +128,11 @@ class PyramidBase:
 
 class PyramidStack(PyramidBase):
     def __init__(self, min_size=constants.DEFAULT_PY_MIN_SIZE, kernel_size=constants.DEFAULT_PY_KERNEL_SIZE,
-                 gen_kernel=constants.DEFAULT_PY_GEN_KERNEL, float_type=constants.DEFAULT_PY_FLOAT):
+                 gen_kernel=constants.DEFAULT_PY_GEN_KERNEL, float_type=constants.DEFAULT_PY_FLOAT,
+                 streaming=constants.DEFAULT_PY_STREAMING, max_threads=constants.DEFAULT_PY_MAX_THREADS):
         super().__init__(min_size, kernel_size, gen_kernel, float_type)
-        self.offset = np.arange(-self.pad_amount, self.pad_amount + 1)
+        self.streaming = streaming
+        self.max_threads = max(1, min(max_threads, os.cpu_count() or 1))
 
     def name(self):
         return "pyramid"
@@ -138,6 +153,29 @@ class PyramidStack(PyramidBase):
             laplacian.append(pyr - expanded)
         return laplacian[::-1]
 
+    def process_frame(self, frame, levels, load):
+        return self.process_single_image(load(frame), levels)
+
+    def process_frames(self, frames, levels, load):
+        if self.max_threads == 1:
+            for frame in frames:
+                yield frame, self.process_frame(frame, levels, load)
+            return
+        with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
+            pending = deque()
+            try:
+                for frame in frames:
+                    pending.append((frame, executor.submit(self.process_frame, frame, levels, load)))
+                    if len(pending) > self.max_threads:
+                        frame, future = pending.popleft()
+                        yield frame, future.result()
+                while len(pending) > 0:
+                    frame, future = pending.popleft()
+                    yield frame, future.result()
+            finally:
+                for _, future in pending:
+                    future.cancel()
+
     def fuse_pyramids(self, all_laplacians):
         fused = [self.get_fused_base(np.stack([p[-1] for p in all_laplacians], axis=0))]
         for layer in range(len(all_laplacians[0]) - 2, -1, -1):
@@ -147,6 +185,39 @@ class PyramidStack(PyramidBase):
         self.print_message(': pyramids fusion completed')
         return fused[::-1]
 
+    def begin_streaming(self):
+        self.best_energies = None
+        self.fused_laplacians = None
+
+    def update_streaming(self, laplacian):
+        base = laplacian[-1]
+        gray_base = self.gray_base(base)
+        entropy, deviation = self.entropy(gray_base), self.deviation(gray_base)
+        if self.fused_laplacians is None:
+            self.best_energies = [self.energy(lap) for lap in laplacian[:-1]]
+            self.fused_laplacians = laplacian[:-1]
+            self.best_entropy, self.best_entropy_base = entropy, base
+            self.best_deviation, self.best_deviation_base = deviation, base.copy()
+            return
+        for layer, lap in enumerate(laplacian[:-1]):
+            energy = self.energy(lap)
+            best = energy > self.best_energies[layer]
+            np.copyto(self.best_energies[layer], energy, where=best)
+            np.copyto(self.fused_laplacians[layer], lap, where=best[:, :, np.newaxis])
+        best = entropy > self.best_entropy
+        np.copyto(self.best_entropy, entropy, where=best)
+        np.copyto(self.best_entropy_base, base, where=best[:, :, np.newaxis])
+        best = deviation > self.best_deviation
+        np.copyto(self.best_deviation, deviation, where=best)
+        np.copyto(self.best_deviation_base, base, where=best[:, :, np.newaxis])
+
+    def end_streaming(self):
+        fused_base = ((self.best_entropy_base + self.best_deviation_base) / 2).astype(self.float_type)
+        fused = self.fused_laplacians + [fused_base]
+        self.begin_streaming()
+        self.print_message(': pyramids fusion completed')
+        return fused
+
     def focus_stack(self, filenames):
         metadata = None
         all_laplacians = []
@@ -157,20 +228,120 @@ class PyramidStack(PyramidBase):
             if img is None:
                 raise ImageLoadError(img_path)
             if metadata is None:
-                metadata = get_img_metadata(img)
-                self.dtype = metadata[1]
-                self.num_pixel_values = constants.NUM_UINT8 if self.dtype == np.uint8 else constants.NUM_UINT16
-                self.max_pixel_value = constants.MAX_UINT8 if self.dtype == np.uint8 else constants.MAX_UINT16
+                metadata = self.set_metadata(img)
                 levels = int(np.log2(min(img.shape[:2]) / self.min_size))
             else:
                 validate_image(img, *metadata)
             if self.do_step_callback:
                 self.process.callback('after_step', self.process.id, self.process.name, i)
             if self.process.callback('check_running', self.process.id, self.process.name) is False:
-                raise RunStopException(self.name)
-        for img_path in filenames:
+                raise RunStopException(self.name())
+        if self.streaming:
+            self.begin_streaming()
+        for img_path, laplacian in self.process_frames(filenames, levels, read_img):
             self.print_message(': processing file {}'.format(img_path.split('/')[-1]))
-            img = read_img(img_path)
-            all_laplacians.append(self.process_single_image(img, levels))
-        stacked_image = self.collapse(self.fuse_pyramids(all_laplacians))
+            if self.streaming:
+                self.update_streaming(laplacian)
+            else:
+                all_laplacians.append(laplacian)
+            if self.process.callback('check_running', self.process.id, self.process.name) is False:
+                raise RunStopException(self.name())
+        fused_pyramid = self.end_streaming() if self.streaming else self.fuse_pyramids(all_laplacians)
+        stacked_image = self.collapse(fused_pyramid)
+        self.release_buffers()
         return stacked_image.astype(self.dtype)
+
+
+class PyramidBlock(PyramidStack):
+    def __init__(self, min_size=constants.DEFAULT_PY_MIN_SIZE, kernel_size=constants.DEFAULT_PY_KERNEL_SIZE,
+                 gen_kernel=constants.DEFAULT_PY_GEN_KERNEL, float_type=constants.DEFAULT_PY_FLOAT,
+                 max_threads=constants.DEFAULT_PY_MAX_THREADS, tile_size=constants.DEFAULT_PY_TILE_SIZE):
+        super().__init__(min_size, kernel_size, gen_kernel, float_type, streaming=True, max_threads=max_threads)
+        if tile_size < 4 * min_size:
+            raise InvalidOptionError("tile_size", tile_size, details=f" tile size must be at least {4 * min_size} px")
+        self.tile_size = tile_size
+
+    def name(self):
+        return "pyramid block"
+
+    def tile_ranges(self, size):
+        step = self.tile_step
+        starts = list(range(0, size, step))
+        if len(starts) > 1 and size - starts[-1] < step // 2:
+            starts.pop()
+        return [(start, starts[i + 1] if i + 1 < len(starts) else size) for i, start in enumerate(starts)]
+
+    def feather(self, start, end, first, last, size):
+        coord = np.arange(max(0, start - self.margin), min(size, end + self.margin)) + 0.5
+        ramp = 2 * self.feather_size
+        weight = np.ones(coord.shape, dtype=np.float32)
+        if not first:
+            weight *= np.clip((coord - (start - self.feather_size)) / ramp, 0, 1)
+        if not last:
+            weight *= np.clip(((end + self.feather_size) - coord) / ramp, 0, 1)
+        return weight
+
+    def write_scratch(self, filenames):
+        metadata = None
+        frames = []
+        for i, img_path in enumerate(filenames):
+            self.print_message(': reading file {}'.format(img_path.split('/')[-1]))
+            img = read_img(img_path)
+            if img is None:
+                raise ImageLoadError(img_path)
+            if metadata is None:
+                metadata = self.set_metadata(img)
+            else:
+                validate_image(img, *metadata)
+            frame = np.lib.format.open_memmap(os.path.join(self.scratch_dir, f"frame-{i:04d}.npy"),
+                                              mode='w+', dtype=img.dtype, shape=img.shape)
+            frame[:] = img
+            frame.flush()
+            del frame
+            frames.append(np.load(os.path.join(self.scratch_dir, f"frame-{i:04d}.npy"), mmap_mode='r'))
+            if self.do_step_callback:
+                self.process.callback('after_step', self.process.id, self.process.name, i)
+            if self.process.callback('check_running', self.process.id, self.process.name) is False:
+                raise RunStopException(self.name())
+        return frames
+
+    def fuse_tile(self, frames, y_range, x_range, levels):
+        self.begin_streaming()
+        for _, laplacian in self.process_frames(frames, levels,
+                                                lambda frame: frame[y_range[0]:y_range[1], x_range[0]:x_range[1]]):
+            self.update_streaming(laplacian)
+        return self.collapse(self.end_streaming())
+
+    def focus_stack(self, filenames):
+        self.scratch_dir = tempfile.mkdtemp(prefix='focusstack-')
+        frames = []
+        try:
+            frames = self.write_scratch(filenames)
+            height, width = frames[0].shape[:2]
+            levels = max(0, int(np.log2(min(self.tile_size, height, width) / self.min_size)))
+            self.tile_step = (self.tile_size // 2 ** levels) * 2 ** levels
+            self.margin = 2 ** (levels + 1)
+            self.feather_size = self.margin // 2
+            accumulator = np.lib.format.open_memmap(os.path.join(self.scratch_dir, "accumulator.npy"),
+                                                    mode='w+', dtype=np.float32, shape=frames[0].shape)
+            rows, columns = self.tile_ranges(height), self.tile_ranges(width)
+            n_tiles = len(rows) * len(columns)
+            for i, (y0, y1) in enumerate(rows):
+                w_y = self.feather(y0, y1, i == 0, i == len(rows) - 1, height)
+                y_range = (max(0, y0 - self.margin), min(height, y1 + self.margin))
+                for j, (x0, x1) in enumerate(columns):
+                    self.print_message(': fusing tile {}/{}'.format(i * len(columns) + j + 1, n_tiles))
+                    w_x = self.feather(x0, x1, j == 0, j == len(columns) - 1, width)
+                    x_range = (max(0, x0 - self.margin), min(width, x1 + self.margin))
+                    tile = self.fuse_tile(frames, y_range, x_range, levels)
+                    weight = np.outer(w_y, w_x)
+                    accumulator[y_range[0]:y_range[1], x_range[0]:x_range[1]] += tile * weight[:, :, np.newaxis]
+                    if self.process.callback('check_running', self.process.id, self.process.name) is False:
+                        raise RunStopException(self.name())
+            stacked_image = np.clip(np.rint(accumulator), 0, self.max_pixel_value).astype(self.dtype)
+            del accumulator
+        finally:
+            del frames
+            self.release_buffers()
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
+        return stacked_image
@@ -1,26 +1,51 @@
 import logging
+import multiprocessing
 import os
+import queue
+import sys
+import threading
+from logging.handlers import QueueHandler
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 from .. config.constants import constants
 from .. core.colors import color_str
 from .. core.framework import Job, ActionList
 from .. core.core_utils import check_path_exists
 from .. core.exceptions import ShapeError, BitDepthError, RunStopException
 from .utils import read_img, write_img
+from .frame_cache import FrameCache, set_frame_cache
 
 
 class StackJob(Job):
-    def __init__(self, name, working_path, input_path='', **kwargs):
+    def __init__(self, name, working_path, input_path='', frame_cache=constants.DEFAULT_FRAME_CACHE,
+                 frame_cache_size=constants.DEFAULT_FRAME_CACHE_SIZE, frame_cache_spill=constants.DEFAULT_FRAME_CACHE_SPILL,
+                 **kwargs):
         check_path_exists(working_path)
         self.working_path = working_path
         if input_path == '':
             self.paths = []
         else:
             self.paths = [input_path]
+        self.frame_cache = frame_cache
+        self.frame_cache_size = frame_cache_size
+        self.frame_cache_spill = frame_cache_spill
         Job.__init__(self, name, **kwargs)
 
     def init(self, a):
         a.init(self)
 
+    def run_core(self):
+        if not self.frame_cache:
+            Job.run_core(self)
+            return
+        self.cache = FrameCache(self.frame_cache_size, self.frame_cache_spill)
+        previous_cache = set_frame_cache(self.cache)
+        try:
+            Job.run_core(self)
+        finally:
+            set_frame_cache(previous_cache)
+            self.cache.clear()
+            self.print_message(color_str(": frame cache: " + self.cache.stats_str(), 'blue'))
+
 
 class FramePaths:
     def __init__(self, name, input_path='', output_path='', working_path='', plot_path=constants.DEFAULT_PLOTS_PATH,
@@ -34,6 +59,9 @@ class FramePaths:
         self.reverse_order = reverse_order
         self.scratch_output_dir = scratch_output_dir
 
+    def preserved_files(self):
+        return []
+
     def set_filelist(self):
         self.filenames = self.folder_filelist(self.input_full_path)
         file_list = self.input_full_path.replace(self.working_path, '').lstrip('/')
@@ -56,7 +84,7 @@ class FramePaths:
                     if self.enabled:
                         for filename in list_dir:
                             file_path = os.path.join(self.output_dir, filename)
-                            if os.path.isfile(file_path):
+                            if os.path.isfile(file_path) and filename not in self.preserved_files():
                                 os.remove(file_path)
                         self.print_message(color_str(f": output directory {self.output_path} content erased", 'yellow'))
                     else:
@@ -109,6 +137,9 @@ class FrameMultiDirectory:
                  scratch_output_dir=True, resample=1, reverse_order=constants.DEFAULT_FILE_REVERSE_ORDER, **kwargs):
         FramePaths.__init__(self, name, input_path, output_path, working_path, plot_path, scratch_output_dir, resample, reverse_order, **kwargs)
 
+    def preserved_files(self):
+        return []
+
     def folder_list_str(self):
         if isinstance(self.input_full_path, list):
             file_list = ", ".join([d.replace(self.working_path, '').lstrip('/') for d in self.input_full_path])
@@ -196,25 +227,94 @@ class SubAction:
     def __init__(self, enabled=True):
         self.enabled = enabled
 
+    def preserved_files(self):
+        return []
+
+    def frame_results(self, idx):
+        return None
+
+    def set_frame_results(self, idx, results):
+        pass
+
+
+_worker_actions = None
+
+
+def fork_workers_supported():
+    # forking a process with running threads may deadlock on locks held by other threads, and is unsafe
+    # on macOS: workers are only forked on Linux from a process whose only thread is the main thread,
+    # e.g.: not from the GUI, which runs jobs in a worker thread, nor while a progress bar monitor is alive
+    return sys.platform.startswith('linux') and 'fork' in multiprocessing.get_all_start_methods() and \
+        threading.current_thread() is threading.main_thread() and threading.active_count() == 1
+
+
+class WorkerCallbacks:
+    def __init__(self, messages, stop):
+        self.messages = messages
+        self.stop = stop
+
+    def get(self, key, default=None):
+        if key == 'check_running':
+            return lambda *args: not self.stop.is_set()
+        return lambda *args: self.messages.put((key, args))
+
+
+def _init_worker(actions, messages, stop):
+    global _worker_actions
+    logger = logging.getLogger(__name__ + '.worker')
+    logger.handlers = [QueueHandler(messages)]
+    logger.propagate = False
+    actions.logger = logger
+    actions.callbacks = WorkerCallbacks(messages, stop)
+    _worker_actions = actions
+
+
+def _run_worker_frame(idx, ref_idx):
+    _worker_actions.run_frame(idx, ref_idx)
+    return _worker_actions.frame_results(idx)
+
 
 class CombinedActions(FramesRefActions):
-    def __init__(self, name, actions=[], enabled=True, **kwargs):
+    def __init__(self, name, actions=[], enabled=True, max_workers=constants.DEFAULT_COMBINED_MAX_WORKERS, **kwargs):
         FramesRefActions.__init__(self, name, enabled, **kwargs)
         self.__actions = actions
+        self.max_workers = max(1, max_workers)
+
+    def preceding_actions(self, action):
+        preceding = []
+        for a in self.__actions:
+            if a is action:
+                break
+            if a.enabled:
+                preceding.append(a)
+        return preceding
+
+    def preserved_files(self):
+        # files written by sub-actions in the output directory to be read back by the next run
+        return [f for a in self.__actions if a.enabled for f in a.preserved_files()]
 
     def begin(self):
         FramesRefActions.begin(self)
+        self.step_frames = {}
         for a in self.__actions:
             if a.enabled:
                 a.begin(self)
 
+    def keep_step_frame(self, idx, img):
+        # the reference frame starts both directions of the chain, the last frame is the next reference
+        self.step_frames = {k: v for k, v in self.step_frames.items() if k == self.ref_idx}
+        self.step_frames[idx] = img
+
     def img_ref(self, idx):
-        filename = self.filenames[idx]
-        img = read_img((self.output_dir if self.step_process else self.input_full_path) + "/" + filename)
+        if idx in self.step_frames:
+            img = self.step_frames[idx].copy()
+        else:
+            filename = self.filenames[idx]
+            img = read_img((self.output_dir if self.step_process else self.input_full_path) + "/" + filename)
+            if img is None:
+                raise Exception("Invalid file: " + self.input_full_path + "/" + filename)
         self.dtype = img.dtype
         self.shape = img.shape
-        if img is None:
-            raise Exception("Invalid file: " + self.input_full_path + "/" + filename)
         return img
 
     def run_frame(self, idx, ref_idx):
@@ -239,9 +339,96 @@ class CombinedActions(FramesRefActions):
         self.sub_message_r(': write output image')
         if img is not None:
             write_img(self.output_dir + "/" + filename, img)
+            if self.step_process:
+                self.keep_step_frame(idx, img)
         else:
             self.print_message("No output file resulted from processing input file: " + self.input_full_path + "/" + filename, level=logging.WARNING)
 
+    def frame_results(self, idx):
+        return [a.frame_results(idx) if a.enabled else None for a in self.__actions]
+
+    def set_frame_results(self, idx, results):
+        for a, r in zip(self.__actions, results):
+            if r is not None:
+                a.set_frame_results(idx, r)
+
+    def new_executor(self, max_workers):
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('fork'),
+                                   initializer=_init_worker, initargs=(self, self.worker_messages, self.stop_workers))
+
+    def forward_worker_messages(self):
+        # log records and callbacks of the workers are emitted from the job thread
+        while True:
+            try:
+                message = self.worker_messages.get_nowait()
+            except queue.Empty:
+                return
+            if isinstance(message, logging.LogRecord):
+                self.get_logger().handle(message)
+            else:
+                key, args = message
+                self.callback(key, *args)
+
+    def after_frame(self, idx):
+        self.print_message_r(color_str("step {}/{}: processed file: {}".format(self.count, len(self.filenames),
+                                                                               self.filenames[idx]), "blue"))
+        self.count += 1
+        self.callback('after_step', self.id, self.name, self.count)
+        if self.callback('check_running', self.id, self.name) is False:
+            raise RunStopException(self.name)
+
+    def run_parallel(self):
+        n_frames = len(self.filenames)
+        self.count = 1
+        context = multiprocessing.get_context('fork')
+        self.worker_messages, self.stop_workers = context.Queue(), context.Event()
+        if self.step_process:
+            self.run_frame(self.ref_idx, self.ref_idx)
+            self.after_frame(self.ref_idx)
+            chains = [[(idx, idx - 1) for idx in range(self.ref_idx + 1, n_frames)],
+                      [(idx, idx + 1) for idx in range(self.ref_idx - 1, -1, -1)]]
+            executors = [self.new_executor(1) for _ in chains]
+        else:
+            chains = [[(idx, self.ref_idx)] for idx in range(n_frames)]
+            executors = [self.new_executor(self.max_workers)] * n_frames
+        pending = {}
+        try:
+            for chain, executor in zip(chains, executors):
+                if len(chain) > 0:
+                    pending[executor.submit(_run_worker_frame, *chain[0])] = (chain, executor, 0)
+            while len(pending) > 0:
+                done, _ = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                self.forward_worker_messages()
+                if self.callback('check_running', self.id, self.name) is False:
+                    raise RunStopException(self.name)
+                for future in done:
+                    chain, executor, step = pending.pop(future)
+                    idx = chain[step][0]
+                    self.set_frame_results(idx, future.result())
+                    self.after_frame(idx)
+                    if step + 1 < len(chain):
+                        pending[executor.submit(_run_worker_frame, *chain[step + 1])] = (chain, executor, step + 1)
+        finally:
+            self.stop_workers.set()
+            for future in pending:
+                future.cancel()
+            for executor in set(executors):
+                executor.shutdown(wait=True, cancel_futures=True)
+            self.forward_worker_messages()
+            self.worker_messages.close()
+
+    def run_core(self):
+        if self.max_workers == 1 or not fork_workers_supported():
+            if self.max_workers > 1:
+                self.print_message(color_str(": parallel frames not supported here, frames are processed serially",
+                                             'yellow'), level=logging.WARNING)
+            FramesRefActions.run_core(self)
+            return
+        self.print_message('begin run', end='\n')
+        self.begin()
+        self.run_parallel()
+        self.end()
+
     def end(self):
         for a in self.__actions:
             if a.enabled:
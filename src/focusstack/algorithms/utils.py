@@ -1,24 +1,36 @@
 import cv2
 import os
+import hashlib
 import numpy as np
 import logging
 import matplotlib.pyplot as plt
 from .. config.config import config
 from .. core.exceptions import ShapeError, BitDepthError
+from .frame_cache import get_frame_cache
 
 
 def read_img(file_path):
     if not os.path.isfile(file_path):
         raise Exception("File does not exist: " + file_path)
+    cache = get_frame_cache()
+    img = None if cache is None else cache.get(file_path)
+    if img is not None:
+        return img.copy()
     ext = file_path.split(".")[-1]
     if ext == 'jpeg' or ext == 'jpg':
         img = cv2.imread(file_path)
     elif ext == 'tiff' or ext == 'tif' or ext == 'png':
         img = cv2.imread(file_path, cv2.IMREAD_UNCHANGED)
+    if cache is not None and img is not None:
+        cache.put(file_path, img)
+        return img.copy()
     return img
 
 
 def write_img(file_path, img):
+    cache = get_frame_cache()
+    if cache is not None:
+        cache.invalidate(file_path)
     ext = file_path.split(".")[-1]
     if ext == 'jpeg' or ext == 'jpg':
         cv2.imwrite(file_path, img, [int(cv2.IMWRITE_JPEG_QUALITY), 100])
@@ -28,6 +40,14 @@ def write_img(file_path, img):
         cv2.imwrite(file_path, img)
 
 
+def file_hash(file_path, chunk_size=2 ** 20):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
 def img_8bit(img):
     return (img >> 8).astype('uint8') if img.dtype == np.uint16 else img
 
@@ -5,7 +5,8 @@ import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit, fsolve
 from .. core.colors import color_str
 from .. config.constants import constants
-from .utils import img_8bit, save_plot
+from .. core.exceptions import InvalidOptionError, ImageLoadError
+from .utils import read_img, img_8bit, save_plot
 from .stack_framework import SubAction
 
 CLIP_EXP = 10
@@ -20,7 +21,32 @@ class Vignetting(SubAction):
         self.plot_correction = kwargs.get('plot_correction', False)
         self.plot_summary = kwargs.get('plot_summary', False)
         self.max_correction = kwargs.get('max_correction', constants.DEFAULT_MAX_CORRECTION)
+        self.subsample = kwargs.get('subsample', constants.DEFAULT_VIGNETTING_SUBSAMPLE)
+        self.fit_mode = kwargs.get('fit_mode', constants.DEFAULT_VIGNETTING_FIT)
+        self.fit_samples = kwargs.get('fit_samples', constants.DEFAULT_VIGNETTING_FIT_SAMPLES)
+        if self.fit_mode not in constants.VALID_VIGNETTING_FIT:
+            raise InvalidOptionError("fit_mode", self.fit_mode)
         self.percentiles = np.sort(percentiles)
+        self.radius_maps = {}
+        self.gain_maps = {}
+        self.model = None
+
+    def radius(self, shape, step=1):
+        h, w = shape[:2]
+        y, x = np.ogrid[:h:step, :w:step]
+        return np.sqrt((x.astype(np.float32) - w / 2)**2 + (y.astype(np.float32) - h / 2)**2)
+
+    def radius_map(self, shape):
+        shape = shape[:2]
+        if shape not in self.radius_maps:
+            h, w = shape
+            radii = np.linspace(0, np.sqrt((w / 2)**2 + (h / 2)**2), self.r_steps + 1)
+            # bin i collects radii[i] <= r < radii[i + 1], the extra bin r_steps only holds r = r_max
+            bins = np.searchsorted(radii, self.radius(shape, self.subsample).ravel(), side='right') - 1
+            bins = bins.astype(np.int16 if self.r_steps < np.iinfo(np.int16).max else np.int32)
+            counts = np.bincount(bins, minlength=self.r_steps + 1)[:self.r_steps]
+            self.radius_maps[shape] = bins, counts
+        return self.radius_maps[shape]
 
     def radial_mean_intensity(self, image):
         if len(image.shape) > 2:
@@ -29,15 +55,11 @@ class Vignetting(SubAction):
         self.w_2, self.h_2 = w / 2, h / 2
         self.r_max = np.sqrt((w / 2)**2 + (h / 2)**2)
         radii = np.linspace(0, self.r_max, self.r_steps + 1)
-        mean_intensities = np.zeros(self.r_steps)
-        y, x = np.ogrid[:h, :w]
-        dist_from_center = np.sqrt((x - self.w_2)**2 + (y - self.h_2)**2)
-        for i in range(self.r_steps):
-            mask = (dist_from_center >= radii[i]) & (dist_from_center < radii[i + 1])
-            if np.any(mask):
-                mean_intensities[i] = np.mean(image[mask])
-            else:
-                mean_intensities[i] = np.nan
+        bins, counts = self.radius_map(image.shape)
+        sample = image[::self.subsample, ::self.subsample]
+        sums = np.bincount(bins, weights=sample.ravel(), minlength=self.r_steps + 1)[:self.r_steps]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_intensities = sums / counts
         return (radii[1:] + radii[:-1]) / 2, mean_intensities
 
     def sigmoid(r, i0, k, r0):
@@ -54,24 +76,101 @@ class Vignetting(SubAction):
             res = None
         return res
 
-    def correct_vignetting(self, image, params):
-        h, w = image.shape[:2]
-        y, x = np.ogrid[:h, :w]
-        r = np.sqrt((x - w / 2)**2 + (y - h / 2)**2)
-        vignette = np.clip(Vignetting.sigmoid(r, *params) / self.v0, 1e-6, 1)
+    def vignette(self, shape, params):
+        pars = [np.float32(p) for p in params]
+        vignette = np.clip(Vignetting.sigmoid(self.radius(shape), *pars) / np.float32(self.v0), 1e-6, 1)
         if self.max_correction < 1:
             vignette = (1.0 - self.max_correction) + vignette * self.max_correction
-        if len(image.shape) == 3:
-            vignette = vignette[:, :, np.newaxis]
-            vignette[np.min(image, axis=2) < self.black_threshold, :] = 1
+        return vignette
+
+    def gain(self, shape, params):
+        gain = (1.0 / self.vignette(shape, params)).astype(np.float32)
+        return cv2.merge([gain] * shape[2]) if len(shape) == 3 else gain
+
+    def gain_map(self, shape):
+        if shape not in self.gain_maps:
+            self.gain_maps[shape] = self.gain(shape, self.model)
+        return self.gain_maps[shape]
+
+    def apply_gain(self, image, gain):
+        # corrected values are rounded and saturated, pixels darker than black_threshold are left unchanged
+        darkest = np.minimum.reduce([image[:, :, c] for c in range(image.shape[2])]) if len(image.shape) == 3 else image
+        dark = np.nonzero(darkest < self.black_threshold)
+        dark_pixels = image[dark]
+        cv2.multiply(image, gain, dst=image, dtype=cv2.CV_8U if image.dtype == np.uint8 else cv2.CV_16U)
+        image[dark] = dark_pixels
+        return image
+
+    def correct_vignetting(self, image, params):
+        return self.apply_gain(image.copy(), self.gain(image.shape, params))
+
+    def gray_image(self, img):
+        return cv2.cvtColor(img_8bit(img), cv2.COLOR_BGR2GRAY)
+
+    def percentile_radii(self, pars):
+        return [fsolve(lambda x: Vignetting.sigmoid(x, *pars) / self.v0 - p, pars[2])[0] for p in self.percentiles]
+
+    def plot_fit(self, radii, intensities, pars, label, suffix, title):
+        plt.figure(figsize=(10, 5))
+        plt.plot(radii, intensities, label=label)
+        plt.plot(radii, Vignetting.sigmoid(radii, *pars), label="sigmoid fit")
+        plt.xlabel('radius (pixels)')
+        plt.ylabel('mean intensity')
+        plt.legend()
+        plt.xlim(radii[0], radii[-1])
+        plt.ylim(0)
+        plot_path = f"{self.process.working_path}/{self.process.plot_path}/{self.process.name}-radial-intensity-{suffix}.pdf"
+        save_plot(plot_path)
+        plt.close('all')
+        self.process.callback('save_plot', self.process.id, f"{self.process.name}: intensity\n{title}", plot_path)
+
+    def fit_model(self):
+        if self.fit_mode == constants.VIGNETTING_FIT_REFERENCE:
+            indices = [self.process.ref_idx]
         else:
-            vignette[image < self.black_threshold] = 1
-        return np.clip(image / vignette, 0, 255 if image.dtype == np.uint8 else 65535).astype(image.dtype)
+            indices = np.unique(np.linspace(0, self.process.counts - 1,
+                                            min(self.fit_samples, self.process.counts)).round().astype(int))
+        preceding = [type(a).__name__ for a in self.process.preceding_actions(self)]
+        if len(preceding) > 0:
+            # the model is fitted on the input files, not on frames processed by the preceding sub-actions
+            message = f": vignetting model fitted on input frames before {', '.join(preceding)}"
+            self.process.sub_message(color_str(message, "yellow"), level=logging.WARNING)
+        self.process.sub_message_r(color_str(": compute vignetting model", "light_blue"))
+        profiles = []
+        for i in indices:
+            path = self.process.input_full_path + "/" + self.process.filenames[i]
+            img = read_img(path)
+            if img is None:
+                raise ImageLoadError(path)
+            profiles.append(self.radial_mean_intensity(self.gray_image(img)))
+        radii = profiles[0][0]
+        intensities = np.median([intensities for _, intensities in profiles], axis=0)
+        self.model = self.fit_sigmoid(radii, intensities)
+        if self.model is None:
+            return
+        self.v0 = Vignetting.sigmoid(0, *self.model)
+        i0_fit, k_fit, r0_fit = self.model
+        self.process.sub_message(f": model parameters: i0={i0_fit:.4f}, k={k_fit:.4f}, r0={r0_fit:.4f}",
+                                 level=logging.DEBUG)
+        self.model_radii = self.percentile_radii(self.model)
+        if self.apply_correction:
+            self.gain_map(img.shape)
+        if self.plot_correction:
+            label = "reference frame mean intensity" if len(indices) == 1 else f"median intensity of {len(indices)} frames"
+            self.plot_fit(radii, intensities, self.model, label, "model", "vignetting model")
 
     def run_frame(self, idx, ref_idx, img_0):
+        if self.fit_mode != constants.VIGNETTING_FIT_FRAME:
+            if self.model is None:
+                return img_0
+            for c, r in zip(self.corrections, self.model_radii):
+                c[idx] = r
+            if not self.apply_correction:
+                return img_0
+            self.process.sub_message_r(color_str(": correct vignetting", "light_blue"))
+            return self.apply_gain(img_0, self.gain_map(img_0.shape))
         self.process.sub_message_r(color_str(": compute vignetting", "light_blue"))
-        img = cv2.cvtColor(img_8bit(img_0), cv2.COLOR_BGR2GRAY)
-        radii, intensities = self.radial_mean_intensity(img)
+        radii, intensities = self.radial_mean_intensity(self.gray_image(img_0))
         pars = self.fit_sigmoid(radii, intensities)
         if pars is None:
             return img_0
@@ -80,30 +179,29 @@ class Vignetting(SubAction):
         self.process.sub_message(f": fit parameters: i0={i0_fit:.4f}, k={k_fit:.4f}, r0={r0_fit:.4f}",
                                  level=logging.DEBUG)
         if self.plot_correction:
-            plt.figure(figsize=(10, 5))
-            plt.plot(radii, intensities, label="image mean intensity")
-            plt.plot(radii, Vignetting.sigmoid(radii, *pars), label="sigmoid fit")
-            plt.xlabel('radius (pixels)')
-            plt.ylabel('mean intensity')
-            plt.legend()
-            plt.xlim(radii[0], radii[-1])
-            plt.ylim(0)
             idx_str = "{:04d}".format(idx)
-            plot_path = f"{self.process.working_path}/{self.process.plot_path}/{self.process.name}-radial-intensity-{idx_str}.pdf"
-            save_plot(plot_path)
-            plt.close('all')
-            self.process.callback('save_plot', self.process.id, f"{self.process.name}: intensity\nframe {idx_str}", plot_path)
-        for i, p in enumerate(self.percentiles):
-            self.corrections[i][idx] = fsolve(lambda x: Vignetting.sigmoid(x, *pars) / self.v0 - p, r0_fit)[0]
+            self.plot_fit(radii, intensities, pars, "image mean intensity", idx_str, f"frame {idx_str}")
+        for c, r in zip(self.corrections, self.percentile_radii(pars)):
+            c[idx] = r
         if self.apply_correction:
             self.process.sub_message_r(color_str(": correct vignetting", "light_blue"))
             return self.correct_vignetting(img_0, pars)
         else:
             return img_0
 
+    def frame_results(self, idx):
+        return [c[idx] for c in self.corrections], self.w_2, self.h_2, self.r_max
+
+    def set_frame_results(self, idx, results):
+        corrections, self.w_2, self.h_2, self.r_max = results
+        for c, value in zip(self.corrections, corrections):
+            c[idx] = value
+
     def begin(self, process):
         self.process = process
         self.corrections = [np.full(self.process.counts, None, dtype=float) for p in self.percentiles]
+        if self.fit_mode != constants.VIGNETTING_FIT_FRAME:
+            self.fit_model()
 
     def end(self):
         if self.plot_summary:
@@ -33,8 +33,9 @@ class _Constants:
     SUB_ACTION_TYPES = [ACTION_MASKNOISE, ACTION_VIGNETTING, ACTION_ALIGNFRAMES,
                         ACTION_BALANCEFRAMES]
     STACK_ALGO_PYRAMID = 'Pyramid'
+    STACK_ALGO_PYRAMID_BLOCK = 'Pyramid block'
     STACK_ALGO_DEPTH_MAP = 'Depth map'
-    STACK_ALGO_OPTIONS = [STACK_ALGO_PYRAMID, STACK_ALGO_DEPTH_MAP]
+    STACK_ALGO_OPTIONS = [STACK_ALGO_PYRAMID, STACK_ALGO_PYRAMID_BLOCK, STACK_ALGO_DEPTH_MAP]
     STACK_ALGO_DEFAULT = STACK_ALGO_PYRAMID
     DEFAULT_PLOTS_PATH = 'plots'
 
@@ -43,6 +44,11 @@ class _Constants:
     DEFAULT_FILE_REVERSE_ORDER = False
     DEFAULT_MULTILAYER_FILE_REVERSE_ORDER = True
 
+    DEFAULT_FRAME_CACHE = False
+    DEFAULT_FRAME_CACHE_SIZE = 1024  # MB
+    DEFAULT_FRAME_CACHE_SPILL = False
+    DEFAULT_COMBINED_MAX_WORKERS = 1
+
     DEFAULT_NOISE_MAP_FILENAME = "noise-map/hot_pixels.png"
     DEFAULT_MN_KERNEL_SIZE = 3
     INTERPOLATE_MEAN = 'MEAN'
@@ -56,6 +62,7 @@ class _Constants:
 
     ALIGN_HOMOGRAPHY = "ALIGN_HOMOGRAPHY"
     ALIGN_RIGID = "ALIGN_RIGID"
+    ALIGN_TRANSLATION = "ALIGN_TRANSLATION"
     BORDER_CONSTANT = "BORDER_CONSTANT"
     BORDER_REPLICATE = "BORDER_REPLICATE"
     BORDER_REPLICATE_BLUR = "BORDER_REPLICATE_BLUR"
@@ -76,7 +83,7 @@ class _Constants:
     VALID_DETECTORS = [DETECTOR_SIFT, DETECTOR_ORB, DETECTOR_SURF, DETECTOR_AKAZE, DETECTOR_BRISK]
     VALID_DESCRIPTORS = [DESCRIPTOR_SIFT, DESCRIPTOR_ORB, DESCRIPTOR_AKAZE, DESCRIPTOR_BRISK]
     VALID_MATCHING_METHODS = [MATCHING_KNN, MATCHING_NORM_HAMMING]
-    VALID_TRANSFORMS = [ALIGN_RIGID, ALIGN_HOMOGRAPHY]
+    VALID_TRANSFORMS = [ALIGN_RIGID, ALIGN_HOMOGRAPHY, ALIGN_TRANSLATION]
     VALID_BORDER_MODES = [BORDER_CONSTANT, BORDER_REPLICATE, BORDER_REPLICATE_BLUR]
     VALID_ALIGN_METHODS = [ALIGN_RANSAC, ALIGN_LMEDS]
     NOKNN_METHODS = {'detectors': [DETECTOR_ORB, DETECTOR_SURF, DETECTOR_AKAZE, DETECTOR_BRISK],
@@ -84,6 +91,8 @@ class _Constants:
 
     DEFAULT_DETECTOR = DETECTOR_SIFT
     DEFAULT_DESCRIPTOR = DESCRIPTOR_SIFT
+    DEFAULT_MAX_KEYPOINTS = 0
+    DEFAULT_KEYPOINT_GRID = 8
     DEFAULT_MATCHING_METHOD = MATCHING_KNN
     DEFAULT_FLANN_IDX_KDTREE = 2
     DEFAULT_FLANN_TREES = 5
@@ -100,6 +109,16 @@ class _Constants:
     DEFAULT_BORDER_BLUR = 50
     DEFAULT_ALIGN_SUBSAMPLE = 1
     DEFAULT_ALIGN_FAST_SUBSAMPLING = False
+    DEFAULT_ALIGN_ECC_REFINEMENT = False
+    DEFAULT_ALIGN_ECC_LEVELS = 3
+    DEFAULT_ALIGN_ECC_MIN_LEVEL = 0
+    DEFAULT_ALIGN_ECC_ROI = 1.0
+    DEFAULT_ALIGN_ECC_MAX_ITERS = 50
+    DEFAULT_ALIGN_ECC_EPSILON = 1e-5
+    DEFAULT_ALIGN_PHASE_SCALE = False
+    DEFAULT_ALIGN_MIN_CONFIDENCE = 0.1
+    DEFAULT_ALIGN_APPLY_CACHED = False
+    ALIGN_TRANSFORMS_FILE = 'alignment-transforms.json'
 
     BALANCE_LINEAR = "LINEAR"
     BALANCE_GAMMA = "GAMMA"
@@ -120,6 +139,13 @@ class _Constants:
     DEFAULT_R_STEPS = 100
     DEFAULT_BLACK_THRESHOLD = 1
     DEFAULT_MAX_CORRECTION = 1
+    DEFAULT_VIGNETTING_SUBSAMPLE = 1
+    VIGNETTING_FIT_FRAME = "FRAME"
+    VIGNETTING_FIT_REFERENCE = "REFERENCE"
+    VIGNETTING_FIT_MEDIAN = "MEDIAN"
+    VALID_VIGNETTING_FIT = [VIGNETTING_FIT_FRAME, VIGNETTING_FIT_REFERENCE, VIGNETTING_FIT_MEDIAN]
+    DEFAULT_VIGNETTING_FIT = VIGNETTING_FIT_FRAME
+    DEFAULT_VIGNETTING_FIT_SAMPLES = 5
 
     FLOAT_32 = 'float-32'
     FLOAT_64 = 'float-64'
@@ -144,11 +170,26 @@ class _Constants:
     DEFAULT_DM_SMOOTH_SIZE = 15
     DEFAULT_DM_TEMPERATURE = 0.1
     DEFAULT_DM_LEVELS = 3
+    DM_CACHE_NONE = "none"
+    DM_CACHE_RAM = "ram"
+    DM_CACHE_MMAP = "mmap"
+    VALID_DM_CACHE = [DM_CACHE_NONE, DM_CACHE_RAM, DM_CACHE_MMAP]
+    DEFAULT_DM_CACHE = DM_CACHE_NONE
+    DEFAULT_DM_CACHE_SIZE = 2048  # MB
+    DM_VOLUME_RAM = "ram"
+    DM_VOLUME_MMAP = "mmap"
+    VALID_DM_VOLUME = [DM_VOLUME_RAM, DM_VOLUME_MMAP]
+    DEFAULT_DM_VOLUME = DM_VOLUME_RAM
+    DEFAULT_DM_MAX_THREADS = 8
+    DEFAULT_DM_ENERGY_DOWNSAMPLE = 1
 
     DEFAULT_PY_FLOAT = FLOAT_32
     DEFAULT_PY_MIN_SIZE = 32
     DEFAULT_PY_KERNEL_SIZE = 5
     DEFAULT_PY_GEN_KERNEL = 0.4
+    DEFAULT_PY_STREAMING = False
+    DEFAULT_PY_MAX_THREADS = 8
+    DEFAULT_PY_TILE_SIZE = 1024
 
     DEFAULT_PLOT_STACK_BUNCH = False
     DEFAULT_PLOT_STACK = True
@@ -9,6 +9,9 @@ class InvalidOptionError(FocusStackError):
         self.details = details
         super().__init__(f"Invalid option {option} = {value}" + ("" if details == "" else f": {details}"))
 
+    def __reduce__(self):
+        return self.__class__, (self.option, self.value, self.details)
+
 
 class ImageLoadError(FocusStackError):
     def __init__(self, path, details=""):
@@ -16,6 +19,9 @@ class ImageLoadError(FocusStackError):
         self.details = details
         super().__init__(f"Failed to load {path}" + ("" if details == "" else f": {details}"))
 
+    def __reduce__(self):
+        return self.__class__, (self.path, self.details)
+
 
 class ImageSaveError(FocusStackError):
     def __init__(self, path, details=""):
@@ -23,6 +29,9 @@ class ImageSaveError(FocusStackError):
         self.details = details
         super().__init__(f"Failed to save {path}" + ("" if details == "" else f": {details}"))
 
+    def __reduce__(self):
+        return self.__class__, (self.path, self.details)
+
 
 class AlignmentError(FocusStackError):
     def __init__(self, index, details):
@@ -30,21 +39,38 @@ class AlignmentError(FocusStackError):
         self.details = details
         super().__init__(f"Alignment failed for image {index}: {details}")
 
+    def __reduce__(self):
+        return self.__class__, (self.index, self.details)
+
 
 class BitDepthError(FocusStackError):
     def __init__(self, dtype_ref, dtype):
+        self.dtype_ref = dtype_ref
+        self.dtype = dtype
         super().__init__(f"Image has type {dtype}, expected {dtype_ref}.")
 
+    def __reduce__(self):
+        return self.__class__, (self.dtype_ref, self.dtype)
+
 
 class ShapeError(FocusStackError):
     def __init__(self, shape_ref, shape):
+        self.shape_ref = shape_ref
+        self.shape = shape
         super().__init__(f'''
 Image has shape ({shape[1]}x{shape[0]}), while it was expected ({shape_ref[1]}x{shape_ref[0]}).
 ''')
 
+    def __reduce__(self):
+        return self.__class__, (self.shape_ref, self.shape)
+
 
 class RunStopException(FocusStackError):
     def __init__(self, name):
+        self.name = name
         if name != "":
             name = f"{name} "
         super().__init__(f"Job {name}stopped")
+
+    def __reduce__(self):
+        return self.__class__, (self.name,)
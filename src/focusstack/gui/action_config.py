@@ -460,6 +460,13 @@ class JobConfigurator(DefaultActionConfigurator):
         self.builder.add_field('working_path', FIELD_ABS_PATH, 'Working path', required=True)
         self.builder.add_field('input_path', FIELD_REL_PATH, 'Input path', required=False,
                                must_exist=True, placeholder='relative to working path')
+        if self.expert:
+            self.builder.add_field('frame_cache', FIELD_BOOL, 'Frame cache', required=False,
+                                   default=constants.DEFAULT_FRAME_CACHE)
+            self.builder.add_field('frame_cache_size', FIELD_INT, 'Frame cache size (MB)', required=False,
+                                   default=constants.DEFAULT_FRAME_CACHE_SIZE, min=0, max=1048576)
+            self.builder.add_field('frame_cache_spill', FIELD_BOOL, 'Spill frame cache to disk', required=False,
+                                   default=constants.DEFAULT_FRAME_CACHE_SPILL)
 
 
 class NoiseDetectionConfigurator(DefaultActionConfigurator):
@@ -497,6 +504,8 @@ class FocusStackBaseConfigurator(DefaultActionConfigurator):
     ENERGY_OPTIONS = ['Laplacian', 'Sobel']
     MAP_TYPE_OPTIONS = ['Average', 'Maximum']
     FLOAT_OPTIONS = ['float 32 bits', 'float 64 bits']
+    CACHE_OPTIONS = ['None', 'Memory', 'Memory-mapped file']
+    VOLUME_OPTIONS = ['Memory', 'Memory-mapped file']
 
     def create_form(self, layout, action):
         super().create_form(layout, action)
@@ -527,12 +536,16 @@ class FocusStackBaseConfigurator(DefaultActionConfigurator):
         stacked.addWidget(q_pyramid)
         stacked.addWidget(q_depthmap)
 
+        tile_size = None
+
         def change():
             text = combo.currentText()
-            if text == 'Pyramid':
+            if text in (constants.STACK_ALGO_PYRAMID, constants.STACK_ALGO_PYRAMID_BLOCK):
                 stacked.setCurrentWidget(q_pyramid)
-            elif text == 'Depth map':
+            elif text == constants.STACK_ALGO_DEPTH_MAP:
                 stacked.setCurrentWidget(q_depthmap)
+            if tile_size is not None:
+                tile_size.setEnabled(text == constants.STACK_ALGO_PYRAMID_BLOCK)
         change()
         if self.expert:
             self.builder.add_field('pyramid_min_size', FIELD_INT, 'Minimum size (px)',
@@ -548,6 +561,15 @@ class FocusStackBaseConfigurator(DefaultActionConfigurator):
                                    add_to_layout=q_pyramid.layout(), options=self.FLOAT_OPTIONS, values=constants.VALID_FLOATS,
                                    default={k: v for k, v in
                                             zip(constants.VALID_FLOATS, self.FLOAT_OPTIONS)}[constants.DEFAULT_PY_FLOAT])
+            self.builder.add_field('pyramid_max_threads', FIELD_INT, 'Max. num. of threads',
+                                   required=False, add_to_layout=q_pyramid.layout(),
+                                   default=constants.DEFAULT_PY_MAX_THREADS, min=1, max=64)
+            self.builder.add_field('pyramid_streaming', FIELD_BOOL, 'Streaming (low memory)', required=False,
+                                   add_to_layout=q_pyramid.layout(), default=constants.DEFAULT_PY_STREAMING)
+            tile_size = self.builder.add_field('block_tile_size', FIELD_INT, 'Tile size (px, block only)',
+                                               required=False, add_to_layout=q_pyramid.layout(),
+                                               default=constants.DEFAULT_PY_TILE_SIZE, min=128, max=16384)
+            change()
         self.builder.add_field('depthmap_energy', FIELD_COMBO, 'Energy', required=False,
                                add_to_layout=q_depthmap.layout(),
                                options=self.ENERGY_OPTIONS, values=constants.VALID_DM_ENERGY,
@@ -558,6 +580,9 @@ class FocusStackBaseConfigurator(DefaultActionConfigurator):
                                options=self.MAP_TYPE_OPTIONS, values=constants.VALID_DM_MAP,
                                default={k: v for k, v in
                                         zip(constants.VALID_DM_MAP, self.MAP_TYPE_OPTIONS)}[constants.DEFAULT_DM_MAP])
+        self.builder.add_field('depthmap_energy_downsample', FIELD_INT, 'Energy downsampling', required=False,
+                               add_to_layout=q_depthmap.layout(),
+                               default=constants.DEFAULT_DM_ENERGY_DOWNSAMPLE, min=1, max=8)
         if self.expert:
             self.builder.add_field('depthmap_kernel_size', FIELD_INT, 'Kernel size (px)',
                                    required=False, add_to_layout=q_depthmap.layout(),
@@ -577,6 +602,20 @@ class FocusStackBaseConfigurator(DefaultActionConfigurator):
                                    add_to_layout=q_depthmap.layout(), options=self.FLOAT_OPTIONS, values=constants.VALID_FLOATS,
                                    default={k: v for k, v in
                                             zip(constants.VALID_FLOATS, self.FLOAT_OPTIONS)}[constants.DEFAULT_DM_FLOAT])
+            self.builder.add_field('depthmap_frame_cache', FIELD_COMBO, 'Frame cache', required=False,
+                                   add_to_layout=q_depthmap.layout(), options=self.CACHE_OPTIONS, values=constants.VALID_DM_CACHE,
+                                   default={k: v for k, v in
+                                            zip(constants.VALID_DM_CACHE, self.CACHE_OPTIONS)}[constants.DEFAULT_DM_CACHE])
+            self.builder.add_field('depthmap_cache_size', FIELD_INT, 'Frame cache size (MB)', required=False,
+                                   add_to_layout=q_depthmap.layout(), default=constants.DEFAULT_DM_CACHE_SIZE,
+                                   min=0, max=1048576)
+            self.builder.add_field('depthmap_energy_volume', FIELD_COMBO, 'Energy volume', required=False,
+                                   add_to_layout=q_depthmap.layout(), options=self.VOLUME_OPTIONS, values=constants.VALID_DM_VOLUME,
+                                   default={k: v for k, v in
+                                            zip(constants.VALID_DM_VOLUME, self.VOLUME_OPTIONS)}[constants.DEFAULT_DM_VOLUME])
+            self.builder.add_field('depthmap_max_threads', FIELD_INT, 'Max. num. of threads',
+                                   required=False, add_to_layout=q_depthmap.layout(),
+                                   default=constants.DEFAULT_DM_MAX_THREADS, min=1, max=64)
         self.builder.layout.addRow(stacked)
         combo.currentIndexChanged.connect(change)
 
@@ -674,6 +713,8 @@ class MaskNoiseConfigurator(NoNameActionConfigurator):
 
 
 class VignettingConfigurator(NoNameActionConfigurator):
+    FIT_MODE_OPTIONS = ['Each frame', 'Reference frame', 'Median of sampled frames']
+
     def __init__(self, expert=False):
         super().__init__(expert)
 
@@ -684,8 +725,20 @@ class VignettingConfigurator(NoNameActionConfigurator):
                                    default=constants.DEFAULT_R_STEPS, min=1, max=1000)
             self.builder.add_field('black_threshold', FIELD_INT, 'Black intensity threshold', required=False,
                                    default=constants.DEFAULT_BLACK_THRESHOLD, min=0, max=1000)
+            self.builder.add_field('subsample', FIELD_INT, 'Subsample factor', required=False,
+                                   default=constants.DEFAULT_VIGNETTING_SUBSAMPLE, min=1, max=256)
         self.builder.add_field('max_correction', FIELD_FLOAT, 'Max. correction', required=False,
                                default=constants.DEFAULT_MAX_CORRECTION, min=0, max=1, step=0.05)
+        fit_mode = self.builder.add_field('fit_mode', FIELD_COMBO, 'Fit vignetting model on', required=False,
+                                          options=self.FIT_MODE_OPTIONS, values=constants.VALID_VIGNETTING_FIT,
+                                          default=self.FIT_MODE_OPTIONS[0])
+        fit_samples = self.builder.add_field('fit_samples', FIELD_INT, 'Number of sampled frames', required=False,
+                                             default=constants.DEFAULT_VIGNETTING_FIT_SAMPLES, min=1, max=1000)
+
+        def change_fit_mode():
+            fit_samples.setEnabled(fit_mode.currentText() == self.FIT_MODE_OPTIONS[2])
+        fit_mode.currentIndexChanged.connect(change_fit_mode)
+        change_fit_mode()
         self.add_bold_label("Miscellanea:")
         self.builder.add_field('plot_correction', FIELD_BOOL, 'Plot correction', required=False, default=False)
         self.builder.add_field('plot_summary', FIELD_BOOL, 'Plot summary', required=False, default=False)
@@ -694,7 +747,7 @@ class VignettingConfigurator(NoNameActionConfigurator):
 
 class AlignFramesConfigurator(NoNameActionConfigurator):
     BORDER_MODE_OPTIONS = ['Constant', 'Replicate', 'Replicate and blur']
-    TRANSFORM_OPTIONS = ['Rigid', 'Homography']
+    TRANSFORM_OPTIONS = ['Rigid', 'Homography', 'Translation (phase correlation)']
     METHOD_OPTIONS = ['Random Sample Consensus (RANSAC)', 'Least Median (LMEDS)']
     MATCHING_METHOD_OPTIONS = ['K-nearest neighbors', 'Hamming distance']
 
@@ -740,6 +793,10 @@ class AlignFramesConfigurator(NoNameActionConfigurator):
                                                                     options=constants.VALID_DETECTORS, default=constants.DEFAULT_DETECTOR)
             descriptor = self.descriptor_field = self.builder.add_field('descriptor', FIELD_COMBO, 'Descriptor', required=False,
                                                                         options=constants.VALID_DESCRIPTORS, default=constants.DEFAULT_DESCRIPTOR)
+            self.builder.add_field('max_keypoints', FIELD_INT, 'Max. keypoints (0: no limit)', required=False,
+                                   default=constants.DEFAULT_MAX_KEYPOINTS, min=0, max=1000000)
+            self.builder.add_field('keypoint_grid', FIELD_INT, 'Keypoint grid size', required=False,
+                                   default=constants.DEFAULT_KEYPOINT_GRID, min=1, max=64)
 
             self.add_bold_label("Feature matching:")
             match_method = self.matching_method_field = self.builder.add_field('match_method', FIELD_COMBO, 'Match method', required=False,
@@ -796,6 +853,11 @@ class AlignFramesConfigurator(NoNameActionConfigurator):
                                                   default=constants.DEFAULT_REFINE_ITERS, min=0, max=1000)
             max_iters = self.builder.add_field('max_iters', FIELD_INT, 'Max. iterations (Homography)', required=False,
                                                default=constants.DEFAULT_ALIGN_MAX_ITERS, min=0, max=5000)
+            phase_scale = self.builder.add_field('phase_scale', FIELD_BOOL, 'Recover scale (Translation)', required=False,
+                                                 default=constants.DEFAULT_ALIGN_PHASE_SCALE)
+            min_confidence = self.builder.add_field('min_confidence', FIELD_FLOAT, 'Min. confidence (Translation)',
+                                                    required=False, default=constants.DEFAULT_ALIGN_MIN_CONFIDENCE,
+                                                    min=0, max=1, step=0.05)
 
             def change_transform():
                 text = transform.currentText()
@@ -805,6 +867,16 @@ class AlignFramesConfigurator(NoNameActionConfigurator):
                 elif text == self.TRANSFORM_OPTIONS[1]:
                     refine_iters.setEnabled(False)
                     max_iters.setEnabled(True)
+                elif text == self.TRANSFORM_OPTIONS[2]:
+                    refine_iters.setEnabled(False)
+                    max_iters.setEnabled(False)
+                translation = text == self.TRANSFORM_OPTIONS[2]
+                phase_scale.setEnabled(translation)
+                min_confidence.setEnabled(translation)
+                method.setEnabled(not translation)
+                change_method()
+                if translation:
+                    rans_threshold.setEnabled(False)
             transform.currentIndexChanged.connect(change_transform)
             change_transform()
             subsample = self.builder.add_field('subsample', FIELD_INT, 'Subsample factor', required=False,
@@ -816,6 +888,23 @@ class AlignFramesConfigurator(NoNameActionConfigurator):
                 fast_subsampling.setEnabled(subsample.value() > 1)
             subsample.valueChanged.connect(change_subsample)
             change_subsample()
+            ecc_refinement = self.builder.add_field('ecc_refinement', FIELD_BOOL, 'ECC refinement', required=False,
+                                                    default=constants.DEFAULT_ALIGN_ECC_REFINEMENT)
+            ecc_levels = self.builder.add_field('ecc_levels', FIELD_INT, 'ECC pyramid levels', required=False,
+                                                default=constants.DEFAULT_ALIGN_ECC_LEVELS, min=1, max=8)
+            ecc_min_level = self.builder.add_field('ecc_min_level', FIELD_INT, 'ECC finest pyramid level',
+                                                   required=False, default=constants.DEFAULT_ALIGN_ECC_MIN_LEVEL,
+                                                   min=0, max=8)
+            ecc_roi = self.builder.add_field('ecc_roi', FIELD_FLOAT, 'ECC central ROI fraction', required=False,
+                                             default=constants.DEFAULT_ALIGN_ECC_ROI, min=0.1, max=1.0, step=0.05)
+            ecc_max_iters = self.builder.add_field('ecc_max_iters', FIELD_INT, 'ECC max. iterations', required=False,
+                                                   default=constants.DEFAULT_ALIGN_ECC_MAX_ITERS, min=1, max=1000)
+
+            def change_ecc_refinement():
+                for field in (ecc_levels, ecc_min_level, ecc_roi, ecc_max_iters):
+                    field.setEnabled(ecc_refinement.isChecked())
+            ecc_refinement.stateChanged.connect(change_ecc_refinement)
+            change_ecc_refinement()
             self.add_bold_label("Border:")
             self.builder.add_field('border_mode', FIELD_COMBO, 'Border mode', required=False,
                                    options=self.BORDER_MODE_OPTIONS, values=constants.VALID_BORDER_MODES,
@@ -828,6 +917,9 @@ class AlignFramesConfigurator(NoNameActionConfigurator):
         self.add_bold_label("Miscellanea:")
         self.builder.add_field('plot_summary', FIELD_BOOL, 'Plot summary', required=False, default=False)
         self.builder.add_field('plot_matches', FIELD_BOOL, 'Plot matches', required=False, default=False)
+        self.builder.add_field('plot_profile', FIELD_BOOL, 'Plot timing profile', required=False, default=False)
+        self.builder.add_field('apply_cached_transforms', FIELD_BOOL, 'Apply cached transforms', required=False,
+                               default=constants.DEFAULT_ALIGN_APPLY_CACHED)
 
     def update_params(self, params: Dict[str, Any]) -> bool:
         if self.detector_field and self.descriptor_field and self.matching_method_field:
@@ -8,7 +8,7 @@ from .. algorithms.vignetting import Vignetting
 from .. algorithms.align import AlignFrames
 from .. algorithms.balance import BalanceFrames
 from .. algorithms.stack import FocusStack, FocusStackBunch
-from .. algorithms.pyramid import PyramidStack
+from .. algorithms.pyramid import PyramidStack, PyramidBlock
 from .. algorithms.depth_map import DepthMapStack
 from .. algorithms.multilayer import MultiLayer
 from .project_model import Project, ActionConfig
@@ -105,6 +105,11 @@ class ProjectConverter:
             if stacker == constants.STACK_ALGO_PYRAMID:
                 algo_dict, module_dict = self.filter_dict_keys(action_config.params, 'pyramid_')
                 stack_algo = PyramidStack(**algo_dict)
+            elif stacker == constants.STACK_ALGO_PYRAMID_BLOCK:
+                block_dict, module_dict = self.filter_dict_keys(action_config.params, 'block_')
+                algo_dict, module_dict = self.filter_dict_keys(module_dict, 'pyramid_')
+                algo_dict = {k: v for k, v in algo_dict.items() if k != 'streaming'}
+                stack_algo = PyramidBlock(**algo_dict, **block_dict)
             elif stacker == constants.STACK_ALGO_DEPTH_MAP:
                 algo_dict, module_dict = self.filter_dict_keys(action_config.params, 'depthmap_')
                 stack_algo = DepthMapStack(**algo_dict)
@@ -118,7 +123,7 @@ class ProjectConverter:
             elif action_config.type_name == constants.ACTION_FOCUSSTACKBUNCH:
                 return FocusStackBunch(**module_dict, stack_algo=stack_algo)
             else:
-                raise InvalidOptionError("stracker", stacker, details="valid values are: Pyramid, Depth map.")
+                raise InvalidOptionError("stracker", stacker, details="valid values are: Pyramid, Pyramid block, Depth map.")
         elif action_config.type_name == constants.ACTION_MULTILAYER:
             input_path = list(filter(lambda p: p != '', action_config.params.get('input_path', '').split(";")))
             params = {k: v for k, v in action_config.params.items() if k != 'imput_path'}
@@ -133,8 +138,9 @@ class ProjectConverter:
             enabled = action_config.params.get('enabled', True)
             working_path = action_config.params.get('working_path', '')
             input_path = action_config.params.get('input_path', '')
+            cache_params = {k: v for k, v in action_config.params.items() if k.startswith('frame_cache')}
             stack_job = StackJob(name, working_path, enabled=enabled, input_path=input_path,
-                                 logger_name=logger_name, callbacks=callbacks)
+                                 logger_name=logger_name, callbacks=callbacks, **cache_params)
             for sub in action_config.sub_actions:
                 action = self.action(sub)
                 if action is not None:
@@ -1,4 +1,8 @@
 import logging
+import os
+import cv2
+import numpy as np
+from focusstack.config.constants import constants
 from focusstack.core.logging import setup_logging
 from focusstack.core.exceptions import ShapeError, BitDepthError
 from focusstack.algorithms.stack_framework import StackJob, CombinedActions
@@ -51,9 +55,81 @@ def test_correct():
         assert False
 
 
+class SilentProcess:
+    def sub_message_r(self, msg):
+        pass
+
+
+def reference_correction(image, mask, kernel_size, method):
+    corrected = image.copy()
+    ks2 = kernel_size // 2
+    for y, x in np.argwhere(mask > 0):
+        neighbourhood = image[max(0, y - ks2):y + ks2 + 1, max(0, x - ks2):x + ks2 + 1]
+        for c in range(image.shape[2] if len(image.shape) == 3 else 1):
+            channel = neighbourhood[:, :, c] if len(image.shape) == 3 else neighbourhood
+            valid = channel[channel != 0]
+            if len(valid) > 0:
+                value = np.mean(valid) if method == constants.INTERPOLATE_MEAN else np.median(valid)
+                if len(image.shape) == 3:
+                    corrected[y, x, c] = value
+                else:
+                    corrected[y, x] = value
+    return corrected
+
+
+def test_mask_noise_pixels():
+    rng = np.random.default_rng(1)
+    h, w = 24, 32
+    mask = np.zeros((h, w), dtype=np.uint8)
+    mask.flat[rng.choice(mask.size, 60, replace=False)] = 255
+    # noisy pixels touching the frame edges and corners, and a cluster of adjacent ones
+    mask[0, 0] = mask[h - 1, w - 1] = mask[0, w // 2] = mask[h // 2, w - 1] = 255
+    mask[10:13, 10:13] = 255
+    for dtype in (np.uint8, np.uint16):
+        for shape in ((h, w), (h, w, 3)):
+            image = rng.integers(0, 4, shape).astype(dtype) * rng.integers(1, np.iinfo(dtype).max // 4, shape).astype(dtype)
+            for kernel_size in (3, 5):
+                for method in (constants.INTERPOLATE_MEAN, constants.INTERPOLATE_MEDIAN):
+                    mask_noise = MaskNoise(kernel_size=kernel_size, method=method)
+                    mask_noise.process = SilentProcess()
+                    mask_noise.noise_mask_img = mask
+                    mask_noise.gather_table()
+                    corrected = mask_noise.run_frame(0, 0, image)
+                    assert corrected.dtype == image.dtype
+                    assert np.array_equal(corrected, reference_correction(image, mask, kernel_size, method))
+    mask_noise = MaskNoise()
+    mask_noise.process = SilentProcess()
+    mask_noise.noise_mask_img = mask
+    mask_noise.gather_table()
+    shape_err = False
+    try:
+        mask_noise.run_frame(0, 0, np.zeros((h, w + 1, 3), dtype=np.uint8))
+    except ShapeError:
+        shape_err = True
+    assert shape_err
+
+
+def test_correct_many_pixels():
+    try:
+        shape = cv2.imread("../examples/input/img-jpg/0000.jpg").shape[:2]
+        mask = np.zeros(shape, dtype=np.uint8)
+        mask.flat[np.random.default_rng(0).choice(mask.size, 20000, replace=False)] = 255
+        os.makedirs("../examples/output/noise-map-many", exist_ok=True)
+        cv2.imwrite("../examples/output/noise-map-many/hot-rgb.png", mask)
+        job = StackJob("job", "../examples/", input_path="input/img-jpg", callbacks='tqdm')
+        job.add_action(CombinedActions("noise", [MaskNoise(noise_mask="output/noise-map-many/hot-rgb.png",
+                                                           method=constants.INTERPOLATE_MEDIAN)],
+                                       output_path="output/img-noise-corr-many"))
+        job.run()
+    except Exception:
+        assert False
+
+
 if __name__ == '__main__':
     test_detect_fail_1()
     test_detect_fail_2()
     test_detect_fail_3()
     test_detect()
     test_correct()
+    test_mask_noise_pixels()
+    test_correct_many_pixels()
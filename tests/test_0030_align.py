@@ -1,9 +1,14 @@
 import matplotlib
 matplotlib.use('Agg')
+import os
+import cv2
+import numpy as np
 from focusstack.config.constants import constants
 from focusstack.algorithms.utils import read_img
+from focusstack.algorithms import stack_framework
 from focusstack.algorithms.stack_framework import StackJob, CombinedActions
-from focusstack.algorithms.align import align_images, AlignFrames
+from focusstack.algorithms.align import align_images, detect_features, transform_features, warp_image, \
+    refine_transform_ecc, select_keypoints, AlignFrames
 
 
 def test_align():
@@ -70,21 +75,208 @@ def test_align_rescale():
 def test_align_ecc():
     try:
         img_1, img_2 = [read_img(f"../examples/input/img-jpg/000{i}.jpg") for i in (2, 3)]
-        n_good_matches, M, img_warp = align_images(img_1, img_2, alignment_config={'ecc_refinement': True})
-        assert img_warp is not None
-        assert n_good_matches > 10
+        for ecc_min_level in [0, 1]:
+            n_good_matches, M, img_warp = align_images(img_1, img_2, alignment_config={
+                'ecc_refinement': True, 'subsample': 4, 'ecc_min_level': ecc_min_level})
+            assert img_warp is not None
+            assert n_good_matches > 10
     except Exception:
         assert False
 
 
+def test_align_ecc_level_failure():
+    img_1 = read_img("../examples/input/img-jpg/0002.jpg")
+    img_2 = warp_image(img_1, np.float32([[1, 0, 3], [0, 1, -2]]), {'border_mode': constants.BORDER_REPLICATE})
+    M_0 = np.float64([[1, 0, -2], [0, 1, 1]])
+    find_transform_ecc = cv2.findTransformECC
+    calls = []
+
+    def fail_first(*args):
+        calls.append(len(calls))
+        if len(calls) == 1:
+            raise cv2.error("no convergence")
+        return find_transform_ecc(*args)
+    cv2.findTransformECC = fail_first
+    try:
+        M = refine_transform_ecc(img_1, img_2, M_0, {'ecc_levels': 3})
+    finally:
+        cv2.findTransformECC = find_transform_ecc
+    assert len(calls) == 3
+    assert np.allclose(M[:, 2], [-3, 2], atol=0.5)
+
+
+def test_align_ecc_features():
+    img_1, img_2 = [read_img(f"../examples/input/img-jpg/000{i}.jpg") for i in (2, 3)]
+    carried = []
+    callbacks = {'features': lambda kp, des, M, shape: carried.append(M)}
+    n_good_matches, M, img_warp = align_images(img_1, img_2, alignment_config={'ecc_refinement': True, 'subsample': 2},
+                                               callbacks=callbacks)
+    assert len(carried) == 1
+    assert np.allclose(carried[0][:, :2], M[:, :2], atol=1e-5)
+    assert np.allclose(carried[0][:, 2] * 2, M[:, 2], atol=1e-3)
+
+
+def test_align_max_keypoints():
+    img_1, img_2 = [read_img(f"../examples/input/img-jpg/000{i}.jpg") for i in (2, 3)]
+    feature_config = {'max_keypoints': 300}
+    kp, des = detect_features(img_1, feature_config)
+    assert len(kp) <= 300
+    assert len(des) == len(kp)
+    n_good_matches, M, img_warp = align_images(img_1, img_2, feature_config=feature_config)
+    assert img_warp is not None
+    assert n_good_matches > 10
+
+
+def test_select_keypoints_small_budget():
+    # strong keypoints crowded in the top-left corner, weak ones spread over the frame
+    keypoints = [cv2.KeyPoint(float(x), float(y), 1, -1, 100.0) for x in range(5) for y in range(5)]
+    keypoints += [cv2.KeyPoint(x * 100.0 + 50, y * 100.0 + 50, 1, -1, 1.0) for x in range(8) for y in range(8)]
+    shape = (800, 800)
+    for max_keypoints in [4, 10, 50]:
+        selected = select_keypoints(keypoints, shape, max_keypoints)
+        assert len(selected) == max_keypoints
+        grid = int(np.sqrt(max_keypoints))
+        cells = {(int(kp.pt[0] * grid / 800), int(kp.pt[1] * grid / 800)) for kp in selected}
+        assert len(cells) == grid * grid
+
+
+def test_transform_features():
+    img = read_img("../examples/input/img-jpg/0002.jpg")
+    h, w = img.shape[:2]
+    kp, des = detect_features(img)
+    kp_t, des_t, matcher = transform_features(kp, des, np.float32([[1, 0, 0], [0, 1, 0]]), img.shape)
+    assert len(kp_t) == len(kp) and len(des_t) == len(des)
+    assert transform_features(kp, des, np.float32([[1, 0, w + 10], [0, 1, 0]]), img.shape) is None
+    assert transform_features([], des[:0], np.float32([[1, 0, 0], [0, 1, 0]]), img.shape) is None
+
+
+def test_align_translation():
+    img_1 = read_img("../examples/input/img-jpg/0002.jpg")
+    h, w = img_1.shape[:2]
+    M_true = cv2.getRotationMatrix2D((w / 2, h / 2), 0, 1.01)
+    M_true[:, 2] += (3.3, -2.7)
+    img_0 = cv2.warpAffine(img_1, M_true, (w, h), borderMode=cv2.BORDER_REPLICATE)
+    M_inv = cv2.invertAffineTransform(M_true)
+    for phase_scale in [False, True]:
+        confidence, M, img_warp = align_images(img_1, img_0, alignment_config={
+            'transform': constants.ALIGN_TRANSLATION, 'phase_scale': phase_scale})
+        assert img_warp is not None
+        assert confidence > 0.3
+    assert abs(M[0, 0] - M_inv[0, 0]) < 1e-3
+    assert np.abs(M[:, 2] - M_inv[:, 2]).max() < 0.5
+
+
+def test_warp_border_blur():
+    img = read_img("../examples/input/img-jpg/0002.jpg")
+    h, w = img.shape[:2]
+    M = cv2.getRotationMatrix2D((w / 2, h / 2), 0.5, 1.01)
+    M[0, 2] += -12.3
+    M[1, 2] += 7.7
+    H = np.vstack([M, [2e-6, -3e-6, 1]])
+    for transform in [M, H]:
+        for image in [img, img[:, :, 1]]:
+            img_warp = warp_image(image, transform)
+            warp = cv2.warpAffine if transform.shape == (2, 3) else cv2.warpPerspective
+            expected = warp(image, transform, (w, h), borderMode=cv2.BORDER_REPLICATE)
+            mask = warp(np.ones_like(image), transform, (w, h), borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+            blurred = cv2.GaussianBlur(expected, (21, 21), sigmaX=constants.DEFAULT_BORDER_BLUR)
+            expected[mask == 0] = blurred[mask == 0]
+            assert np.array_equal(img_warp, expected)
+
+
 def test_jpg():
     try:
         job = StackJob("job", "../examples", input_path="input/img-jpg", callbacks='tqdm')
-        job.add_action(CombinedActions("align-jpg", [AlignFrames(plot_summary=True)],
+        job.add_action(CombinedActions("align-jpg", [AlignFrames(plot_summary=True, plot_profile=True)],
                                        output_path="output/img-jpg-align"))
         job.run()
     except Exception:
         assert False
+    with open(f"../examples/{constants.DEFAULT_PLOTS_PATH}/align-jpg-profile.csv") as f:
+        rows = f.read().splitlines()
+    assert rows[0].startswith("frame,filename,subsample,detection,matching,ransac")
+    assert len(rows) == 6
+
+
+def test_jpg_translation():
+    try:
+        job = StackJob("job", "../examples", input_path="input/img-jpg")
+        align = AlignFrames(transform=constants.ALIGN_TRANSLATION, phase_scale=True, subsample=2, plot_summary=True)
+        job.add_action(CombinedActions("align-jpg-translation", [align], step_process=True,
+                                       output_path="output/img-jpg-align-translation"))
+        job.run()
+    except Exception:
+        assert False
+    assert np.min(np.delete(align.n_matches, len(align.n_matches) // 2)) > constants.DEFAULT_ALIGN_MIN_CONFIDENCE
+
+
+class RefCountActions(CombinedActions):
+    def __init__(self, name, actions, **kwargs):
+        super().__init__(name, actions, **kwargs)
+        self.ref_reads = 0
+
+    def img_ref(self, idx):
+        self.ref_reads += 1
+        return super().img_ref(idx)
+
+
+def test_jpg_ref_features():
+    for step_process in [False, True]:
+        try:
+            align = AlignFrames()
+            actions = RefCountActions("align-jpg-ref", [align], step_process=step_process,
+                                      output_path="output/img-jpg-align-ref")
+            job = StackJob("job", "../examples", input_path="input/img-jpg")
+            job.add_action(actions)
+            job.run()
+        except Exception:
+            assert False
+        assert actions.ref_reads == 1
+        assert np.min(np.delete(align.n_matches, actions.ref_idx)) > 10
+
+
+def test_jpg_step_frames():
+    read_paths = []
+
+    def counting_read_img(path):
+        read_paths.append(path)
+        return read_img(path)
+    stack_framework.read_img = counting_read_img
+    try:
+        align = AlignFrames(plot_matches=True)
+        job = StackJob("job", "../examples", input_path="input/img-jpg")
+        job.add_action(CombinedActions("align-jpg-step", [align], step_process=True,
+                                       output_path="output/img-jpg-align-step"))
+        job.run()
+    except Exception:
+        assert False
+    finally:
+        stack_framework.read_img = read_img
+    assert len(read_paths) == 6
+    assert not any("img-jpg-align-step" in path for path in read_paths)
+    assert np.min(np.delete(align.n_matches, len(align.n_matches) // 2)) > 10
+
+
+def test_jpg_cached_transforms():
+    for step_process in [False, True]:
+        n_matches, ref_reads = [], []
+        for apply_cached in [False, True, True]:
+            try:
+                align = AlignFrames(apply_cached_transforms=apply_cached)
+                actions = RefCountActions("align-jpg-cached", [align], step_process=step_process,
+                                          output_path="output/img-jpg-align-cached")
+                job = StackJob("job", "../examples", input_path="input/img-jpg")
+                job.add_action(actions)
+                job.run()
+            except Exception:
+                assert False
+            n_matches.append(align.n_matches)
+            ref_reads.append(actions.ref_reads)
+            transforms_file = f"../examples/output/img-jpg-align-cached/{constants.ALIGN_TRANSFORMS_FILE}"
+            assert os.path.isfile(transforms_file) == apply_cached
+            assert len(align.hashes) == 0 or apply_cached
+        assert ref_reads == [1, 1, 0]
+        assert np.array_equal(n_matches[1], n_matches[2])
 
 
 def test_tif():
@@ -100,8 +292,20 @@ def test_tif():
 if __name__ == '__main__':
     test_align()
     test_align_rescale()
+    test_align_ecc()
+    test_align_ecc_level_failure()
+    test_align_ecc_features()
+    test_align_max_keypoints()
+    test_select_keypoints_small_budget()
+    test_transform_features()
+    test_align_translation()
+    test_warp_border_blur()
     test_align_2()
     test_align_3()
     test_align_4()
     test_jpg()
+    test_jpg_translation()
+    test_jpg_ref_features()
+    test_jpg_step_frames()
+    test_jpg_cached_transforms()
     test_tif()
@@ -6,6 +6,7 @@ if "pytest" in sys.modules:
     matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from focusstack.config.constants import constants
+from focusstack.algorithms.utils import read_img
 from focusstack.algorithms.align import align_images
 np.random.seed(123456)
 
@@ -65,7 +66,7 @@ def compare_transformations(M_true, M_aligned):
     assert abs(scale_diff) < 0.0001
 
 
-def compare_alignment(color_test=False):
+def compare_alignment(color_test=False, alignment_config=None):
     original = create_test_image(color=color_test)
     transformed, M_true = apply_transform(original)
     original_bgr = ensure_3channel(original)
@@ -73,7 +74,7 @@ def compare_alignment(color_test=False):
     try:
         n_matches, M_recovered, aligned = align_images(
             transformed_bgr, original_bgr,
-            alignment_config={'transform': constants.ALIGN_RIGID}
+            alignment_config={'transform': constants.ALIGN_RIGID, **(alignment_config or {})}
         )
     except Exception as e:
         print(f"Alignment failed: {e}")
@@ -104,8 +105,27 @@ def test_alignment_color():
     compare_alignment(True)
 
 
+def test_alignment_ecc():
+    compare_alignment(False, {'subsample': 2, 'ecc_refinement': True})
+    compare_alignment(True, {'subsample': 2, 'ecc_refinement': True, 'ecc_roi': 0.6})
+
+
+def test_alignment_ecc_subsample():
+    original = read_img("../examples/input/img-jpg/0002.jpg")
+    transformed, M_true = apply_transform(original)
+    for alignment_config in [{'subsample': 4}, {'subsample': 8}, {'subsample': 4, 'ecc_min_level': 1}]:
+        n_matches, M_recovered, aligned = align_images(
+            transformed, original,
+            alignment_config={'transform': constants.ALIGN_RIGID, 'ecc_refinement': True, **alignment_config}
+        )
+        compare_transformations(M_true, M_recovered)
+
+
 if __name__ == "__main__":
     print("=== TEST GRAYSCALE ===")
     test_alignment_bw()
     print("\n=== TEST COLOR ===")
     test_alignment_color()
+    print("\n=== TEST ECC REFINEMENT ===")
+    test_alignment_ecc()
+    test_alignment_ecc_subsample()
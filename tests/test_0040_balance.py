@@ -1,6 +1,25 @@
+import numpy as np
 from focusstack.config.constants import constants
 from focusstack.algorithms.stack_framework import StackJob, CombinedActions
-from focusstack.algorithms.balance import BalanceFrames
+from focusstack.algorithms.balance import BalanceFrames, SVCorrection, LSCorrection, GammaMap
+from focusstack.algorithms.utils import read_img
+
+
+def test_gamma_correction():
+    rng = np.random.default_rng(0)
+    for dtype, n in [(np.uint8, 256), (np.uint16, 65536)]:
+        ref_hist = np.bincount(rng.normal(0.6 * n, 0.1 * n, 100000).clip(0, n - 1).astype(int), minlength=n)
+        hist = np.bincount(rng.normal(0.4 * n, 0.15 * n, 100000).clip(0, n - 1).astype(int), minlength=n)
+        gamma_map = GammaMap(dtype, [ref_hist])
+        gamma = gamma_map.correction([hist])[0]
+        assert 1 < gamma < 5
+        mean = np.average(gamma_map.lut(gamma).astype(float), weights=hist)
+        assert abs(mean - gamma_map.reference[0]) < 0.5
+        # a single pixel value is corrected exactly by the closed form
+        single = np.zeros(n)
+        single[n // 4] = 1
+        gamma = gamma_map.correction([single])[0]
+        assert abs(gamma_map.map_values(n // 4, gamma) - gamma_map.reference[0] - 0.5) < 1e-6
 
 
 def test_tif_rgb_match():
@@ -16,6 +35,19 @@ def test_tif_rgb_match():
         assert False
 
 
+def test_jpg_rgb_match():
+    try:
+        job = StackJob("job", "../examples", input_path="input/img-jpg", callbacks='tqdm')
+        job.add_action(CombinedActions("balance",
+                                       [BalanceFrames(channel=constants.BALANCE_RGB,
+                                                      corr_map=constants.BALANCE_MATCH_HIST,
+                                                      plot_summary=True)],
+                                       output_path="output/img-jpg-balance-rgb-match"))
+        job.run()
+    except Exception:
+        assert False
+
+
 def test_jpg_lumi():
     try:
         job = StackJob("job", "../examples", input_path="input/img-jpg", callbacks='tqdm')
@@ -81,10 +113,40 @@ def test_jpg_hls():
         assert False
 
 
+def test_jpg_rgb_mask():
+    try:
+        job = StackJob("job", "../examples", input_path="input/img-jpg", callbacks='tqdm')
+        job.add_action(CombinedActions("balance",
+                                       [BalanceFrames(channel=constants.BALANCE_RGB,
+                                                      corr_map=constants.BALANCE_LINEAR,
+                                                      mask_size=0.8, subsample=4, plot_summary=True)],
+                                       output_path="output/img-jpg-balance-rgb-mask"))
+        job.run()
+    except Exception:
+        assert False
+
+
+def test_hsv_hls_16bit():
+    try:
+        frames = [read_img(f"../examples/input/img-jpg/{i:04d}.jpg").astype(np.uint16) * 257 for i in range(2)]
+        for correction in [SVCorrection(corr_map=constants.BALANCE_LINEAR), LSCorrection(corr_map=constants.BALANCE_GAMMA)]:
+            correction.begin(frames[0], 2, 0)
+            ref = correction.apply_correction(0, frames[0])
+            assert ref.dtype == np.uint16 and np.abs(ref.astype(int) - frames[0]).max() <= 2
+            img = correction.apply_correction(1, frames[1])
+            assert img.dtype == np.uint16 and img.shape == frames[1].shape
+    except Exception:
+        assert False
+
+
 if __name__ == '__main__':
+    test_gamma_correction()
     test_tif_rgb_match()
+    test_jpg_rgb_match()
     test_jpg_lumi()
     test_tif_lumi()
     test_jpg_rgb()
     test_jpg_hsv()
     test_jpg_hls()
+    test_jpg_rgb_mask()
+    test_hsv_hls_16bit()
@@ -1,4 +1,8 @@
+import os
+import numpy as np
 from focusstack.config.constants import constants
+from focusstack.core.exceptions import RunStopException
+from focusstack.algorithms.utils import read_img
 from focusstack.algorithms.stack_framework import StackJob, CombinedActions
 from focusstack.algorithms.align import AlignFrames
 from focusstack.algorithms.balance import BalanceFrames
@@ -52,8 +56,75 @@ def test_lumi():
         assert False
 
 
+def test_frame_cache():
+    try:
+        for cache in [False, True]:
+            suffix = '-cache' if cache else ''
+            job = StackJob("job", "../examples", input_path="input/img-jpg",
+                           frame_cache=cache, frame_cache_size=20, frame_cache_spill=True)
+            job.add_action(CombinedActions("balance-lumi", [BalanceFrames(channel=constants.BALANCE_LUMI)],
+                                           output_path=f"output/img-jpg-balance-lumi{suffix}"))
+            job.add_action(CombinedActions("balance-rgb", [BalanceFrames(channel=constants.BALANCE_RGB)],
+                                           input_path="input/img-jpg", output_path=f"output/img-jpg-balance-rgb{suffix}"))
+            job.run()
+    except Exception:
+        assert False
+    assert job.cache.disk_hits > 0 and job.cache.misses == len(os.listdir("../examples/input/img-jpg"))
+    for path in ["output/img-jpg-balance-lumi", "output/img-jpg-balance-rgb"]:
+        for filename in os.listdir("../examples/" + path):
+            assert np.array_equal(read_img(f"../examples/{path}/{filename}"),
+                                  read_img(f"../examples/{path}-cache/{filename}"))
+
+
+def test_parallel():
+    try:
+        outputs = []
+        for max_workers in [1, 3]:
+            job = StackJob("job", "../examples", input_path="input/img-jpg")
+            balance = BalanceFrames(channel=constants.BALANCE_LUMI)
+            actions = CombinedActions("balance", [balance], step_process=False, max_workers=max_workers,
+                                      output_path=f"output/img-jpg-balance-lumi-workers-{max_workers}")
+            job.add_action(actions)
+            job.run()
+            outputs.append((actions.output_dir, balance.correction.corrections))
+    except Exception:
+        assert False
+    (dir_1, corrections_1), (dir_n, corrections_n) = outputs
+    assert np.array_equal(corrections_1, corrections_n)
+    for filename in os.listdir(dir_1):
+        assert np.array_equal(read_img(f"{dir_1}/{filename}"), read_img(f"{dir_n}/{filename}"))
+
+
+def test_parallel_callbacks():
+    for stop_after in [None, 2]:
+        calls = []
+
+        def check_running(id, name):
+            return stop_after is None or len([c for c in calls if c[0] == 'after_step']) < stop_after
+        callbacks = {key: (lambda key: lambda *args: calls.append((key, *args)))(key)
+                     for key in ['step_counts', 'begin_steps', 'end_steps', 'after_step', 'save_plot']}
+        callbacks['check_running'] = check_running
+        job = StackJob("job", "../examples", input_path="input/img-jpg", callbacks=callbacks)
+        job.add_action(CombinedActions("align", [AlignFrames(plot_matches=True)], max_workers=2,
+                                       output_path="output/img-jpg-align-workers"))
+        try:
+            job.run()
+            stopped = False
+        except RunStopException:
+            stopped = True
+        plots = [c for c in calls if c[0] == 'save_plot' and 'matches' in c[2]]
+        if stop_after is None:
+            assert not stopped
+            assert len(plots) == len(os.listdir("../examples/input/img-jpg")) - 1
+        else:
+            assert stopped
+
+
 if __name__ == '__main__':
     test_hls_gamma()
     test_hsv()
     test_rgb()
     test_lumi()
+    test_frame_cache()
+    test_parallel()
+    test_parallel_callbacks()
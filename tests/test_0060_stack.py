@@ -1,9 +1,66 @@
+import os
+import threading
+import cv2
+import numpy as np
+from focusstack.config.constants import constants
+from focusstack.algorithms.utils import read_img, write_img
 from focusstack.algorithms.stack_framework import StackJob
 from focusstack.algorithms.stack import FocusStack, FocusStackBunch
-from focusstack.algorithms.pyramid import PyramidStack
+from focusstack.algorithms.pyramid import PyramidStack, PyramidBlock
 from focusstack.algorithms.depth_map import DepthMapStack
 
 
+def reference_entropy(stack, image):
+    levels, counts = np.unique(image, return_counts=True)
+    probabilities = np.zeros((stack.num_pixel_values), dtype=stack.float_type)
+    probabilities[levels] = counts.astype(stack.float_type) / counts.sum()
+    pad = stack.pad_amount
+    padded = cv2.copyMakeBorder(image, pad, pad, pad, pad, cv2.BORDER_REFLECT101)
+    result = np.zeros(image.shape, dtype=stack.float_type)
+    for row in range(image.shape[0]):
+        for column in range(image.shape[1]):
+            area = padded[row:row + 2 * pad + 1, column:column + 2 * pad + 1].flatten()
+            result[row, column] = -1. * (area * np.log(probabilities[area])).sum()
+    return result
+
+
+def reference_deviation(stack, image):
+    pad = stack.pad_amount
+    padded = cv2.copyMakeBorder(image, pad, pad, pad, pad, cv2.BORDER_REFLECT101)
+    result = np.zeros(image.shape, dtype=stack.float_type)
+    for row in range(image.shape[0]):
+        for column in range(image.shape[1]):
+            area = padded[row:row + 2 * pad + 1, column:column + 2 * pad + 1]
+            result[row, column] = np.square(area - np.average(area).astype(stack.float_type)).sum() / area.size
+    return result
+
+
+def check_fused_base(dtype, num_pixel_values):
+    rng = np.random.default_rng(1234)
+    stack = PyramidStack()
+    stack.dtype = dtype
+    stack.num_pixel_values = num_pixel_values
+    images = rng.integers(0, num_pixel_values, size=(3, 24, 32, 3)).astype(dtype)
+    images[:, :6, :6] = 0
+    gray_images = [cv2.cvtColor(img.astype(np.float32), cv2.COLOR_BGR2GRAY).astype(dtype) for img in images]
+    entropies = np.array([stack.entropy(img) for img in gray_images])
+    deviations = np.array([stack.deviation(img) for img in gray_images])
+    ref_entropies = np.array([reference_entropy(stack, img) for img in gray_images])
+    ref_deviations = np.array([reference_deviation(stack, img) for img in gray_images])
+    assert np.allclose(entropies, ref_entropies, rtol=1e-5)
+    assert np.allclose(deviations, ref_deviations, rtol=1e-5)
+    assert np.array_equal(np.argmax(entropies, axis=0), np.argmax(ref_entropies, axis=0))
+    assert np.array_equal(np.argmax(deviations, axis=0), np.argmax(ref_deviations, axis=0))
+
+
+def test_fused_base_8bit():
+    check_fused_base(np.uint8, constants.NUM_UINT8)
+
+
+def test_fused_base_16bit():
+    check_fused_base(np.uint16, constants.NUM_UINT16)
+
+
 def test_jpg():
     try:
         job = StackJob("job", "../examples", input_path="input/img-jpg")
@@ -14,6 +71,101 @@ def test_jpg():
         assert False
 
 
+def test_jpg_streaming():
+    try:
+        job = StackJob("job", "../examples", input_path="input/img-jpg")
+        job.add_action(FocusStack("stack-pyramid", PyramidStack(),
+                                  output_path="output/img-jpg-stack-batch", prefix='pyr_'))
+        job.add_action(FocusStack("stack-pyramid-streaming", PyramidStack(streaming=True),
+                                  input_path="input/img-jpg", output_path="output/img-jpg-stack-streaming", prefix='pyr_'))
+        job.run()
+    except Exception:
+        assert False
+    img_batch = read_img("../examples/output/img-jpg-stack-batch/pyr_0000.jpg")
+    img_streaming = read_img("../examples/output/img-jpg-stack-streaming/pyr_0000.jpg")
+    assert np.array_equal(img_batch, img_streaming)
+
+
+def test_jpg_block():
+    try:
+        job = StackJob("job", "../examples", input_path="input/img-jpg")
+        job.add_action(FocusStack("stack-pyramid-block", PyramidBlock(tile_size=1024),
+                                  output_path="output/img-jpg-stack-block", prefix='pyr_'))
+        job.run()
+    except Exception:
+        assert False
+    img_batch = read_img("../examples/output/img-jpg-stack-batch/pyr_0000.jpg")
+    img_block = read_img("../examples/output/img-jpg-stack-block/pyr_0000.jpg")
+    assert img_block.shape == img_batch.shape
+    assert np.mean(np.abs(img_block.astype(np.float32) - img_batch.astype(np.float32))) < 2
+
+
+class SilentProcess:
+    id, name = 0, "stack"
+
+    def sub_message_r(self, msg):
+        pass
+
+    def callback(self, *args):
+        return None
+
+
+def stack_frames(stacker, filenames):
+    stacker.process = SilentProcess()
+    return stacker.focus_stack(filenames).astype(np.int32)
+
+
+def test_block_equivalence():
+    filenames = [f"../examples/input/img-jpg/{i:04d}.jpg" for i in range(6)]
+    img_full = stack_frames(PyramidStack(), filenames)
+    # a single tile covering the frame only differs by rounding
+    img_single = stack_frames(PyramidBlock(tile_size=2048), filenames)
+    assert np.abs(img_single - img_full).max() <= 1
+    # tiles use their own base-level entropy and deviation statistics, feathered seams
+    # must not add differences on top of those
+    stacker = PyramidBlock(tile_size=1024)
+    diff = np.abs(stack_frames(stacker, filenames) - img_full).max(axis=2)
+    overlap = np.zeros(diff.shape, dtype=bool)
+    for start, _ in stacker.tile_ranges(diff.shape[1])[1:]:
+        overlap[:, start - stacker.margin:start + stacker.margin] = True
+    assert overlap.any()
+    assert diff[overlap].max() <= 12
+    assert np.percentile(diff[overlap], 99) <= 8
+    assert diff[overlap].max() <= diff[~overlap].max()
+
+
+def test_depth_map_messages():
+    filenames = [f"../examples/input/img-jpg/{i:04d}.jpg" for i in range(6)]
+    messages = []
+
+    class RecordingProcess(SilentProcess):
+        def sub_message_r(self, msg):
+            messages.append((threading.get_ident(), msg))
+
+    stacker = DepthMapStack()
+    stacker.max_threads = 3
+    stacker.process = RecordingProcess()
+    stacker.focus_stack(filenames)
+    assert all(thread == threading.get_ident() for thread, _ in messages)
+    reads = [msg for _, msg in messages if 'reading file (1/2)' in msg]
+    assert [f"{i:04d}.jpg" in msg for i, msg in enumerate(reads)] == [True] * len(filenames)
+
+
+def test_block_small_frames():
+    try:
+        os.makedirs("../examples/output/img-jpg-small", exist_ok=True)
+        for i in range(2):
+            img = read_img(f"../examples/input/img-jpg/{i:04d}.jpg")
+            write_img(f"../examples/output/img-jpg-small/{i:04d}.png", cv2.resize(img, (24, 16)))
+        job = StackJob("job", "../examples", input_path="output/img-jpg-small")
+        job.add_action(FocusStack("stack-pyramid-block", PyramidBlock(tile_size=128),
+                                  output_path="output/img-jpg-small-stack", prefix='pyr_'))
+        job.run()
+    except Exception:
+        assert False
+    assert read_img("../examples/output/img-jpg-small-stack/pyr_0000.png").shape == (16, 24, 3)
+
+
 def test_tif():
     try:
         job = StackJob("job", "../examples", input_path="input/img-tif")
@@ -34,6 +186,56 @@ def test_jpg_dm():
         assert False
 
 
+def test_jpg_dm_cache():
+    try:
+        job = StackJob("job", "../examples", input_path="input/img-jpg")
+        job.add_action(FocusStack("stack-depthmap-nocache", DepthMapStack(),
+                                  output_path="output/img-jpg-stack-dm-nocache", prefix='dm_'))
+        job.add_action(FocusStack("stack-depthmap-ram", DepthMapStack(frame_cache=constants.DM_CACHE_RAM, cache_size=20),
+                                  input_path="input/img-jpg", output_path="output/img-jpg-stack-dm-ram", prefix='dm_'))
+        job.add_action(FocusStack("stack-depthmap-mmap", DepthMapStack(frame_cache=constants.DM_CACHE_MMAP),
+                                  input_path="input/img-jpg", output_path="output/img-jpg-stack-dm-mmap", prefix='dm_'))
+        job.run()
+    except Exception:
+        assert False
+    img_nocache = read_img("../examples/output/img-jpg-stack-dm-nocache/dm_0000.jpg")
+    for cache in ['ram', 'mmap']:
+        assert np.array_equal(img_nocache, read_img(f"../examples/output/img-jpg-stack-dm-{cache}/dm_0000.jpg"))
+
+
+def test_jpg_dm_volume():
+    try:
+        job = StackJob("job", "../examples", input_path="input/img-jpg")
+        for map_type in constants.VALID_DM_MAP:
+            job.add_action(FocusStack(f"stack-depthmap-{map_type}", DepthMapStack(map_type=map_type),
+                                      input_path="input/img-jpg", output_path=f"output/img-jpg-stack-dm-{map_type}", prefix='dm_'))
+            job.add_action(FocusStack(f"stack-depthmap-{map_type}-mmap",
+                                      DepthMapStack(map_type=map_type, energy_volume=constants.DM_VOLUME_MMAP),
+                                      input_path="input/img-jpg", output_path=f"output/img-jpg-stack-dm-{map_type}-mmap", prefix='dm_'))
+        job.run()
+    except Exception:
+        assert False
+    for map_type in constants.VALID_DM_MAP:
+        assert np.array_equal(read_img(f"../examples/output/img-jpg-stack-dm-{map_type}/dm_0000.jpg"),
+                              read_img(f"../examples/output/img-jpg-stack-dm-{map_type}-mmap/dm_0000.jpg"))
+
+
+def test_jpg_dm_downsample():
+    try:
+        job = StackJob("job", "../examples", input_path="input/img-jpg")
+        job.add_action(FocusStack("stack-depthmap", DepthMapStack(),
+                                  output_path="output/img-jpg-stack-dm-full", prefix='dm_'))
+        job.add_action(FocusStack("stack-depthmap-downsample", DepthMapStack(energy_downsample=2),
+                                  input_path="input/img-jpg", output_path="output/img-jpg-stack-dm-downsample", prefix='dm_'))
+        job.run()
+    except Exception:
+        assert False
+    img_full = read_img("../examples/output/img-jpg-stack-dm-full/dm_0000.jpg")
+    img_downsample = read_img("../examples/output/img-jpg-stack-dm-downsample/dm_0000.jpg")
+    assert img_full.shape == img_downsample.shape
+    assert np.mean(np.abs(img_full.astype(float) - img_downsample)) < 2
+
+
 def test_bunches():
     try:
         job = StackJob("job", "../examples", input_path="input/img-jpg")
@@ -45,7 +247,17 @@ def test_bunches():
 
 
 if __name__ == '__main__':
+    test_fused_base_8bit()
+    test_fused_base_16bit()
     test_jpg()
+    test_jpg_streaming()
+    test_jpg_block()
+    test_block_equivalence()
+    test_block_small_frames()
+    test_depth_map_messages()
     test_tif()
     test_jpg_dm()
+    test_jpg_dm_cache()
+    test_jpg_dm_volume()
+    test_jpg_dm_downsample()
     test_bunches()
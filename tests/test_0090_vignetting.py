@@ -1,5 +1,11 @@
+import os
+import shutil
+import numpy as np
+from focusstack.config.constants import constants
+from focusstack.core.exceptions import ImageLoadError
 from focusstack.algorithms.stack_framework import StackJob, CombinedActions
 from focusstack.algorithms.vignetting import Vignetting
+from focusstack.algorithms.align import AlignFrames
 
 
 def test_vignetting():
@@ -13,5 +19,77 @@ def test_vignetting():
         assert False
 
 
+def test_vignetting_subsample():
+    try:
+        job = StackJob("job", "../examples", input_path="../examples/input/img-vignetted")
+        vignetting = Vignetting(subsample=4, plot_summary=True)
+        job.add_action(CombinedActions("vignette", [vignetting],
+                                       output_path="output/img-vignetting-subsample"))
+        job.run()
+    except Exception:
+        assert False
+    for shape, (bins, counts) in vignetting.radius_maps.items():
+        assert bins.dtype == np.int16
+        assert bins.size == ((shape[0] + 3) // 4) * ((shape[1] + 3) // 4)
+
+
+def test_vignetting_preceding_actions():
+    align, vignetting = AlignFrames(), Vignetting(fit_mode=constants.VIGNETTING_FIT_REFERENCE)
+    actions = CombinedActions("vignette", [AlignFrames(enabled=False), align, vignetting, AlignFrames()])
+    assert actions.preceding_actions(vignetting) == [align]
+    assert actions.preceding_actions(align) == []
+
+
+def test_vignetting_rounding():
+    vignetting = Vignetting()
+    vignetting.model = np.array([200.0, 0.01, 300.0])
+    vignetting.v0 = Vignetting.sigmoid(0, *vignetting.model)
+    for dtype in (np.uint8, np.uint16):
+        image = np.random.default_rng(0).integers(0, np.iinfo(dtype).max // 2, (120, 160, 3)).astype(dtype)
+        corrected = vignetting.correct_vignetting(image, vignetting.model)
+        assert np.array_equal(corrected, vignetting.apply_gain(image.copy(), vignetting.gain_map(image.shape)))
+        gain = 1.0 / vignetting.vignette(image.shape, vignetting.model)[:, :, np.newaxis]
+        expected = np.clip(np.rint(image * gain), 0, np.iinfo(dtype).max)
+        bright = np.min(image, axis=2) >= vignetting.black_threshold
+        assert np.abs(corrected[bright].astype(float) - expected[bright]).max() <= 1e-3 * np.iinfo(dtype).max
+        assert np.array_equal(corrected[~bright], image[~bright])
+
+
+def test_vignetting_unreadable_sample():
+    os.makedirs("../examples/output/img-vignetting-broken-input", exist_ok=True)
+    shutil.copy("../examples/input/img-vignetted/" + sorted(os.listdir("../examples/input/img-vignetted"))[0],
+                "../examples/output/img-vignetting-broken-input/0000.jpg")
+    with open("../examples/output/img-vignetting-broken-input/0001.jpg", "w") as f:
+        f.write("not an image")
+    job = StackJob("job", "../examples", input_path="output/img-vignetting-broken-input")
+    job.add_action(CombinedActions("vignette", [Vignetting(fit_mode=constants.VIGNETTING_FIT_MEDIAN)],
+                                   output_path="output/img-vignetting-broken"))
+    load_err = False
+    try:
+        job.run()
+    except ImageLoadError:
+        load_err = True
+    assert load_err
+
+
+def test_vignetting_shared_model():
+    try:
+        for fit_mode in [constants.VIGNETTING_FIT_REFERENCE, constants.VIGNETTING_FIT_MEDIAN]:
+            job = StackJob("job", "../examples", input_path="../examples/input/img-vignetted")
+            vignetting = Vignetting(fit_mode=fit_mode, fit_samples=3, plot_correction=True, plot_summary=True)
+            job.add_action(CombinedActions("vignette", [vignetting],
+                                           output_path=f"output/img-vignetting-{fit_mode.lower()}"))
+            job.run()
+            assert vignetting.model is not None
+            assert len(vignetting.gain_maps) == 1
+    except Exception:
+        assert False
+
+
 if __name__ == '__main__':
     test_vignetting()
+    test_vignetting_subsample()
+    test_vignetting_preceding_actions()
+    test_vignetting_rounding()
+    test_vignetting_unreadable_sample()
+    test_vignetting_shared_model()